@@ -18,12 +18,159 @@
 
 from types import *
 from functional import *
+from collections import OrderedDict
 import sys
+import thread
+import weakref
+import operator
 
 
 __version__ = '0.8.0'
 
+#Whether LazyExprs capture only the names their code refers to, rather
+#than copying the caller's namespaces, when not told otherwise.
+_captureByDefault = 0
 
+def setCapture(flag):
+    """
+    Sets whether LazyExprs capture only the names they refer to by default;
+    see LazyExpr.__init__.
+    """
+    global _captureByDefault
+    _captureByDefault = flag and 1 or 0
+
+class CodeCache:
+    """
+    A bounded cache of the code compiled from LazyExpr source strings, so
+    that expressions created over and over (in a loop, say, or by LazyExpr's
+    own operators) are compiled only once. When the cache is full, the
+    least recently used code is dropped.
+    """
+    def __init__(self, size = 256):
+        self._lock = thread.allocate_lock()
+        self._codes = OrderedDict()
+        self._size = size
+        self._hits = 0
+        self._misses = 0
+
+    def compile(self, source):
+        """
+        Returns the code for the expression *source*, compiling it if it
+        isn't cached.
+        """
+        self._lock.acquire()
+        try:
+            code = self._codes.pop(source, None)
+            if code is not None:
+                self._codes[source] = code
+                self._hits = self._hits + 1
+                return code
+            self._misses = self._misses + 1
+        finally:
+            self._lock.release()
+        code = compile(source, 'Lazy expr: ' + source, 'eval')
+        self._lock.acquire()
+        try:
+            if self._size > 0:
+                self._codes[source] = code
+                while len(self._codes) > self._size:
+                    self._codes.popitem(0)
+        finally:
+            self._lock.release()
+        return code
+
+    def setSize(self, size):
+        """
+        Sets the most entries the cache holds, dropping the least recently
+        used ones if there are more. A size of zero turns caching off.
+        """
+        self._lock.acquire()
+        try:
+            self._size = size
+            while len(self._codes) > max(size, 0):
+                self._codes.popitem(0)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Empties the cache and resets its counters.
+        """
+        self._lock.acquire()
+        try:
+            self._codes.clear()
+            self._hits = 0
+            self._misses = 0
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        """
+        Returns a dictionary of the cache's 'hits' and 'misses', and its
+        current and maximum sizes ('entries' and 'size').
+        """
+        self._lock.acquire()
+        try:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'entries': len(self._codes), 'size': self._size}
+        finally:
+            self._lock.release()
+
+_codeCache = CodeCache()
+
+def getCodeCache():
+    """
+    Returns the CodeCache LazyExpr uses for source strings.
+    """
+    return _codeCache
+
+def codeNames(code):
+    """
+    Returns a tuple of the names *code* refers to, including those in any
+    lambdas or other code nested in it. Attribute names are included too,
+    since code objects don't distinguish them.
+    """
+    names = code.co_names
+    for const in code.co_consts:
+        if type(const) == CodeType:
+            names = names + codeNames(const)
+    return names
+
+class Captured(object):
+    """
+    The names a LazyExpr's code refers to, and their values, captured when
+    the expression was created. Uses slots, so that it takes far less room
+    than a dictionary, let alone a copy of a module's namespace.
+    """
+    __slots__ = ('names', 'values')
+
+    def __init__(self, code, globs, locs):
+        """
+        Captures each name *code* refers to from *locs*, or failing that
+        from *globs*. Names found in neither, such as builtins and
+        attribute names, are left out.
+        """
+        names = []
+        values = []
+        for name in codeNames(code):
+            if locs.has_key(name):
+                value = locs[name]
+            elif globs.has_key(name):
+                value = globs[name]
+            else:
+                continue
+            if name not in names:
+                names.append(name)
+                values.append(value)
+        self.names = tuple(names)
+        self.values = tuple(values)
+
+    def namespace(self):
+        """
+        Returns a new dictionary of the captured names and values, suitable
+        for eval.
+        """
+        return dict(zip(self.names, self.values))
 
         
 def isLazy(thing):
@@ -31,7 +178,7 @@ def isLazy(thing):
     Returns 1 if *thing* is a Lazy expression, 0 otherwise.
     """
     try:
-        return isinstance(thing, Lazy)
+        return isinstance(thing, Lazy) or isinstance(thing, (LazyCell, LazyNode))
     except:
         return 0
 
@@ -78,19 +225,41 @@ class LazyExpr(Lazy):
     #Now laz can be used in any context, and will always evaluate to 25, even if
     #a changes or goes out of scope.
     """
-    def __init__(self, code, globs = {}, locs = {}):
+    def __init__(self, code, globs = {}, locs = {}, capture = None, threadSafe = 0):
         """
         *code* can be either a code object or a string. Either way, it should
-        be an expression, not a statement. If the *globs* or *locs* params are
-        omitted, the global and local namespaces of the caller will be used
-        for evaluation.
+        be an expression, not a statement. Strings are compiled through the
+        module's CodeCache; see getCodeCache. If the *globs* or *locs* params
+        are omitted, the global and local namespaces of the caller will be
+        used for evaluation.
+
+        Normally the caller's namespaces are copied, which costs time in
+        proportion to their size. If *capture* is true (or if it is None and
+        setCapture(1) has been called), only the names *code* refers to are
+        copied, into a Captured, so a LazyExpr created in a large module
+        costs no more than one created anywhere else. The expression is then
+        evaluated in a namespace holding just those names.
+
+        Normally a LazyExpr forced by two threads at once may be evaluated
+        twice, or fail in one of them. If *threadSafe* is true, it is
+        evaluated exactly once: any other threads forcing it meanwhile wait
+        for that evaluation, and if it raises an exception, the exception is
+        kept and raised again whenever the expression is forced.
         """
         if type(code) == StringType:
-            code = compile(code, 'Lazy expr: ' + code, 'eval')
+            code = _codeCache.compile(code)
         self.__dict__['_code'] = code
+        if threadSafe:
+            self.__dict__['_lock'] = thread.allocate_lock()
+        if capture is None:
+            capture = _captureByDefault
         if not globs or not locs:
             frame = getStackFrame().f_back
             l, g = frame.f_locals, frame.f_globals
+            if capture:
+                self.__dict__['_globs'] = Captured(code, globs or g, locs or l)
+                self.__dict__['_locs'] = None
+                return
             if not locs:
                 locs = l.copy()
             if not globs:
@@ -103,12 +272,42 @@ class LazyExpr(Lazy):
         Forces (and returns) the evaluation of the expression.
         """
         if not self.__dict__.has_key('_value'):
-            self.__dict__['_value'] = eval(self._code, self._globs, self._locs)
-            #Delete namespaces so we don't prevent GC on their contents...
-            del self.__dict__['_globs']
-            del self.__dict__['_locs']
+            lock = self.__dict__.get('_lock')
+            if lock is None:
+                self.__dict__['_value'] = self._evaluate()
+                #Delete namespaces so we don't prevent GC on their contents...
+                del self.__dict__['_globs']
+                del self.__dict__['_locs']
+            else:
+                self._evaluateOnce(lock)
         return self.__dict__['_value']
 
+    def _evaluate(self):
+        globs = self._globs
+        if isinstance(globs, Captured):
+            return eval(self._code, globs.namespace())
+        return eval(self._code, globs, self._locs)
+
+    def _evaluateOnce(self, lock):
+        """
+        Evaluates a thread safe expression, unless another thread already
+        has, and raises the exception the evaluation raised, if any.
+        """
+        lock.acquire()
+        try:
+            if not self.__dict__.has_key('_value') and not self.__dict__.has_key('_error'):
+                try:
+                    self.__dict__['_value'] = self._evaluate()
+                except:
+                    self.__dict__['_error'] = sys.exc_info()
+                del self.__dict__['_globs']
+                del self.__dict__['_locs']
+        finally:
+            lock.release()
+        error = self.__dict__.get('_error')
+        if error is not None:
+            raise error[0], error[1], error[2]
+
     def __str__(self):
         """
         Will cause evaluation.
@@ -132,7 +331,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() * other.eval()", locs = locals())
+            return LazyExpr("self.eval() * other.eval()", locs = locals(), capture = 1)
         return self.eval() * other
 
     def __rmul__(self, other):
@@ -140,7 +339,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() * self.eval()")
+            return LazyExpr("other.eval() * self.eval()", capture = 1)
         return other * self.eval()
 
     def __div__(self, other):
@@ -148,7 +347,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() * other.eval()")
+            return LazyExpr("self.eval() * other.eval()", capture = 1)
         return self.eval()/other
 
     def __rdiv__(self, other):
@@ -156,7 +355,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval()/self.eval()")
+            return LazyExpr("other.eval()/self.eval()", capture = 1)
         return other/self.eval()
 
     def __mod__(self, other):
@@ -164,7 +363,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() % self.eval()")
+            return LazyExpr("other.eval() % self.eval()", capture = 1)
         return other % self.eval()
 
     def __rmod__(self, other):
@@ -172,7 +371,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() % other.eval()")
+            return LazyExpr("self.eval() % other.eval()", capture = 1)
         return self.eval() % other
 
     def __divmod__ (self, other):
@@ -180,7 +379,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("divmod(other.eval(),self.eval())")
+            return LazyExpr("divmod(other.eval(),self.eval())", capture = 1)
         return divmod(other, self.eval())
 
     def __pow__ (self, other, modulo):
@@ -188,7 +387,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("pow(self.eval(), other.eval(), modulo)")
+            return LazyExpr("pow(self.eval(), other.eval(), modulo)", capture = 1)
         return pow(self.eval(), other, modulo)
 
     def __lshift__ (self, other):
@@ -196,7 +395,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() << other.eval()")
+            return LazyExpr("self.eval() << other.eval()", capture = 1)
         return self.eval() << other
 
     def __rshift__ (self, other) :
@@ -204,7 +403,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() >> other.eval()")
+            return LazyExpr("self.eval() >> other.eval()", capture = 1)
         return self.eval() >> other
 
     def __and__ (self, other) :
@@ -212,7 +411,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() & other.eval()")
+            return LazyExpr("self.eval() & other.eval()", capture = 1)
         return self.eval() & other
 
     def __xor__ (self, other):
@@ -220,21 +419,21 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() ^ other.eval()")
+            return LazyExpr("self.eval() ^ other.eval()", capture = 1)
         return self.eval() ^ other
     def __or__ (self, other):
         """
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("self.eval() | other.eval()")
+            return LazyExpr("self.eval() | other.eval()", capture = 1)
 
     def __radd__ (self, other):
         """
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() + self.eval()")
+            return LazyExpr("other.eval() + self.eval()", capture = 1)
         return other + self.eval()
 
     def __rsub__ (self, other):
@@ -242,7 +441,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() - self.eval()")
+            return LazyExpr("other.eval() - self.eval()", capture = 1)
         return other - self.eval()
 
     def __rdivmod__ (self, other):
@@ -250,7 +449,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("divmod(other.eval(), self.eval())")
+            return LazyExpr("divmod(other.eval(), self.eval())", capture = 1)
         return divmod(other + self.eval())
 
     def __rpow__ (self, other):
@@ -258,7 +457,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("pow(other.eval(), self.eval())")
+            return LazyExpr("pow(other.eval(), self.eval())", capture = 1)
         return pow(other, self.eval())
 
     def __rlshift__ (self, other):
@@ -266,7 +465,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() << self.eval()")
+            return LazyExpr("other.eval() << self.eval()", capture = 1)
         return other << self.eval()
 
     def __rrshift__ (self, other):
@@ -274,7 +473,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() >> self.eval()")
+            return LazyExpr("other.eval() >> self.eval()", capture = 1)
         return other >> self.eval()
 
     def __rand__ (self, other):
@@ -282,7 +481,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() & self.eval()")
+            return LazyExpr("other.eval() & self.eval()", capture = 1)
         return other & self.eval()
 
     def __rxor__ (self, other):
@@ -290,7 +489,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() ^ self.eval()")
+            return LazyExpr("other.eval() ^ self.eval()", capture = 1)
         return other ^ self.eval()
 
     def __ror__ (self, other):
@@ -298,7 +497,7 @@ class LazyExpr(Lazy):
         Will cause evaluation, unless *other* is also lazy.
         """
         if isLazy(other):
-            return LazyExpr("other.eval() | self.eval()")
+            return LazyExpr("other.eval() | self.eval()", capture = 1)
         return other | self.eval()
 
     def __neg__ (self):
@@ -348,15 +547,15 @@ class LazyExpr(Lazy):
         Does **not** cause evaluation.
         """
         if isLazy(ntx):
-            return LazyExpr("self.eval()[ntx.eval()]")
+            return LazyExpr("self.eval()[ntx.eval()]", capture = 1)
         else:
-            return LazyExpr("self.eval()[ntx]")
+            return LazyExpr("self.eval()[ntx]", capture = 1)
 
     def __getslice__(self, i, j):
         """
         Does **not** cause evaluation.
         """
-        return LazyExpr("self.eval()[i:j]")
+        return LazyExpr("self.eval()[i:j]", capture = 1)
 
     def __delslice__(self, i, j):
         """
@@ -406,7 +605,7 @@ class LazyExpr(Lazy):
         """
         if name == '__coerce__':
             raise AttributeError, name
-        return LazyExpr("getattr(self.eval(), name)")
+        return LazyExpr("getattr(self.eval(), name)", capture = 1)
 
     def __setattr__(self, name, value):
         """
@@ -443,14 +642,14 @@ class LazyExpr(Lazy):
         Does **not** cause evaluation.
         """
         import copy
-        return LazyExpr("copy.copy(self.eval())")
+        return LazyExpr("copy.copy(self.eval())", capture = 1)
 
     def __deepcopy__(self, dict):
         """
         Does **not** cause evaluation.
         """
         import copy
-        return LazyExpr("copy.deepcopy(self.eval())")
+        return LazyExpr("copy.deepcopy(self.eval())", capture = 1)
 
 class Uncomputed:
     """
@@ -460,6 +659,378 @@ class Uncomputed:
     pass
 
 
+class LazyCell(object):
+    """
+    A compact lazy expression, for when there are a great many of them.
+    It behaves like a LazyExpr created with capture = 1, and supports the
+    same operators, but it uses slots instead of an instance dictionary, so
+    a pending LazyCell takes a fraction of the memory of a LazyExpr. Once
+    evaluated, it holds only its code and value.
+
+    LazyCell is not a subclass of Lazy (a classic class would give it an
+    instance dictionary), but isLazy recognizes it. Unlike LazyExpr, it
+    forces evaluation for the operators LazyExpr only supports by way of
+    __getattr__, such as +, - and truth testing.
+    """
+    __slots__ = ('_code', '_env', '_value')
+
+    def __init__(self, code, globs = {}, locs = {}):
+        """
+        *code*, *globs* and *locs* are as for LazyExpr. Only the names
+        *code* refers to are kept; see Captured.
+        """
+        if type(code) == StringType:
+            code = _codeCache.compile(code)
+        if not globs or not locs:
+            frame = getStackFrame().f_back
+            globs = globs or frame.f_globals
+            locs = locs or frame.f_locals
+        object.__setattr__(self, '_code', code)
+        object.__setattr__(self, '_env', Captured(code, globs, locs))
+        object.__setattr__(self, '_value', Uncomputed)
+
+    def eval(self):
+        """
+        Forces (and returns) the evaluation of the expression.
+        """
+        if self._value is Uncomputed:
+            object.__setattr__(self, '_value', eval(self._code, self._env.namespace()))
+            object.__setattr__(self, '_env', None)
+        return self._value
+
+    def isEvaluated(self):
+        return self._value is not Uncomputed
+
+    def __repr__(self):
+        """
+        Does **not** cause evaluation.
+        """
+        return self._code.co_filename
+
+    def __add__(self, other):
+        """
+        Will cause evaluation, unless *other* is also lazy.
+        """
+        if isLazy(other):
+            return LazyExpr("self.eval() + other.eval()", capture = 1)
+        return self.eval() + other
+
+    def __sub__(self, other):
+        """
+        Will cause evaluation, unless *other* is also lazy.
+        """
+        if isLazy(other):
+            return LazyExpr("self.eval() - other.eval()", capture = 1)
+        return self.eval() - other
+
+    def __floordiv__(self, other):
+        """
+        Will cause evaluation.
+        """
+        return self.eval() // lazyEval(other)
+
+    def __rfloordiv__(self, other):
+        """
+        Will cause evaluation.
+        """
+        return other // self.eval()
+
+    def __truediv__(self, other):
+        """
+        Will cause evaluation.
+        """
+        return self.eval() / lazyEval(other)
+
+    def __rtruediv__(self, other):
+        """
+        Will cause evaluation.
+        """
+        return other / self.eval()
+
+    def __nonzero__(self):
+        """
+        Will cause evaluation.
+        """
+        return not not self.eval()
+
+    def __iter__(self):
+        """
+        Will cause evaluation.
+        """
+        return iter(self.eval())
+
+    def __contains__(self, item):
+        """
+        Will cause evaluation.
+        """
+        return item in self.eval()
+
+    def __hash__(self):
+        """
+        Will cause evaluation.
+        """
+        return hash(self.eval())
+
+#LazyCell shares LazyExpr's operators; they only use eval.
+for _name, _method in LazyExpr.__dict__.items():
+    if _name[:2] == '__' and not LazyCell.__dict__.has_key(_name) and \
+       _name not in ('__init__', '__doc__', '__module__'):
+        setattr(LazyCell, _name, _method)
+del _name, _method
+
+def lazyEval(thing):
+    """
+    Returns *thing* evaluated, if it is lazy, or *thing* itself otherwise.
+    """
+    if isLazy(thing):
+        return thing.eval()
+    return thing
+
+
+def _binary(op):
+    return lambda self, other: _node(op, self, other)
+
+def _reflected(op):
+    return lambda self, other: _node(op, other, self)
+
+def _unary(op):
+    return lambda self: _node(op, self)
+
+def _force(thing):
+    return thing.eval()
+
+def _call(func, kwnames, *values):
+    split = len(values) - len(kwnames)
+    return func(*values[:split], **dict(zip(kwnames, values[split:])))
+
+class LazyNode(object):
+    """
+    A node in a graph of deferred operations. Where an operator on a
+    LazyExpr with a strict operand forces the expression, the same operator
+    on a LazyNode just adds another node to the graph: arithmetic, bitwise
+    operators, comparisons, indexing, attribute access and calls all defer.
+    Nothing is computed until a node is forced, with eval or by an
+    operation which needs a real value (str, int, len, truth testing,
+    iteration and so on), and then only the nodes it depends on are.
+
+    Nodes are shared: applying the same operation to the same operands
+    again returns the existing node, so common subexpressions are only
+    built, and evaluated, once. Calls are shared too, so the functions
+    called in a graph should not have side effects. Use defer to start
+    a graph:
+
+    >>> total = defer(LazyExpr("loadSales()"))
+    >>> margin = (total - costs) / total
+    >>> ratio = (total - costs) / revenue   #reuses the total - costs node
+
+    A node is evaluated in the thread that forces it; nodes are not thread
+    safe.
+    """
+    __slots__ = ('_op', '_args', '_value', '__weakref__')
+
+    def __init__(self, op, args, value = Uncomputed):
+        """
+        Applies *op* to the values of *args* when forced. Nodes should be
+        created with defer rather than directly, so that they are shared.
+        """
+        self._op = op
+        self._args = args
+        self._value = value
+
+    def eval(self):
+        """
+        Forces (and returns) the evaluation of the node, evaluating each
+        node it depends on that has not been already.
+        """
+        if self._value is Uncomputed:
+            #Work through the graph with a stack rather than by recursion,
+            #so that long chains of operations can't overflow the C stack.
+            stack = [self]
+            while stack:
+                node = stack[-1]
+                if node._value is not Uncomputed:
+                    stack.pop()
+                    continue
+                pending = filter(lambda arg: isinstance(arg, LazyNode) and
+                                 arg._value is Uncomputed, node._args)
+                if pending:
+                    stack.extend(pending)
+                else:
+                    stack.pop()
+                    node._value = node._op(*map(_nodeValue, node._args))
+        return self._value
+
+    def isEvaluated(self):
+        return self._value is not Uncomputed
+
+    def __repr__(self):
+        """
+        Does **not** cause evaluation.
+        """
+        if self._op is None:
+            return "LazyNode(%s)" % repr(self._value)
+        return "LazyNode(%s)" % getattr(self._op, '__name__', self._op)
+
+    __add__ = _binary(operator.add)
+    __sub__ = _binary(operator.sub)
+    __mul__ = _binary(operator.mul)
+    __div__ = _binary(operator.div)
+    __truediv__ = _binary(operator.truediv)
+    __floordiv__ = _binary(operator.floordiv)
+    __mod__ = _binary(operator.mod)
+    __divmod__ = _binary(divmod)
+    __lshift__ = _binary(operator.lshift)
+    __rshift__ = _binary(operator.rshift)
+    __and__ = _binary(operator.and_)
+    __xor__ = _binary(operator.xor)
+    __or__ = _binary(operator.or_)
+
+    __radd__ = _reflected(operator.add)
+    __rsub__ = _reflected(operator.sub)
+    __rmul__ = _reflected(operator.mul)
+    __rdiv__ = _reflected(operator.div)
+    __rtruediv__ = _reflected(operator.truediv)
+    __rfloordiv__ = _reflected(operator.floordiv)
+    __rmod__ = _reflected(operator.mod)
+    __rdivmod__ = _reflected(divmod)
+    __rpow__ = _reflected(pow)
+    __rlshift__ = _reflected(operator.lshift)
+    __rrshift__ = _reflected(operator.rshift)
+    __rand__ = _reflected(operator.and_)
+    __rxor__ = _reflected(operator.xor)
+    __ror__ = _reflected(operator.or_)
+
+    __lt__ = _binary(operator.lt)
+    __le__ = _binary(operator.le)
+    __eq__ = _binary(operator.eq)
+    __ne__ = _binary(operator.ne)
+    __gt__ = _binary(operator.gt)
+    __ge__ = _binary(operator.ge)
+
+    __neg__ = _unary(operator.neg)
+    __pos__ = _unary(operator.pos)
+    __abs__ = _unary(abs)
+    __invert__ = _unary(operator.invert)
+
+    __getitem__ = _binary(operator.getitem)
+
+    #Comparisons build nodes, so hash by identity.
+    __hash__ = object.__hash__
+
+    def __pow__(self, other, modulo = None):
+        if modulo is None:
+            return _node(pow, self, other)
+        return _node(pow, self, other, modulo)
+
+    def __getslice__(self, i, j):
+        return _node(operator.getslice, self, i, j)
+
+    def __getattr__(self, name):
+        """
+        Does **not** cause evaluation, except for special names such as
+        __iter__, which are looked up on the value.
+        """
+        if name[:2] == '__':
+            return getattr(self.eval(), name)
+        return _node(getattr, self, name)
+
+    def __call__(self, *args, **kwargs):
+        """
+        Does **not** cause evaluation.
+        """
+        kwnames = tuple(sorted(kwargs.keys()))
+        #One tuple for each set of keywords, so that equal calls share nodes.
+        kwnames = _keywords.setdefault(kwnames, kwnames)
+        return apply(_node, (_call, self, kwnames) + args +
+                     tuple(map(lambda name, kwargs = kwargs: kwargs[name], kwnames)))
+
+    def __str__(self):
+        return str(self.eval())
+
+    def __nonzero__(self):
+        return not not self.eval()
+
+    def __len__(self):
+        return len(self.eval())
+
+    def __iter__(self):
+        return iter(self.eval())
+
+    def __contains__(self, item):
+        return item in self.eval()
+
+    def __int__(self):
+        return int(self.eval())
+
+    def __long__(self):
+        return long(self.eval())
+
+    def __float__(self):
+        return float(self.eval())
+
+    def __complex__(self):
+        return complex(self.eval())
+
+    def __oct__(self):
+        return oct(self.eval())
+
+    def __hex__(self):
+        return hex(self.eval())
+
+    def __index__(self):
+        return operator.index(self.eval())
+
+def _nodeValue(arg):
+    if isinstance(arg, LazyNode):
+        return arg._value
+    return arg
+
+#Every live node, keyed by its operation and the identities of its operands,
+#so that equal subexpressions share a node.
+_nodes = weakref.WeakValueDictionary()
+
+_keywords = {}
+
+#Constants of these types are shared by value rather than by identity.
+_valueTypes = (IntType, LongType, FloatType, ComplexType, StringType,
+               UnicodeType, BooleanType, NoneType)
+
+def _node(op, *args):
+    args = tuple(map(defer, args))
+    key = (op,) + tuple(map(id, args))
+    node = _nodes.get(key)
+    if node is None:
+        node = LazyNode(op, args)
+        _nodes[key] = node
+    return node
+
+def defer(thing):
+    """
+    Returns a LazyNode for *thing*, so that operations on it build a graph
+    of LazyNodes rather than being carried out straight away. If *thing* is
+    lazy, it is forced when the node is; otherwise it is a constant. The
+    same node is returned for the same lazy object, or for equal constants
+    of the basic types.
+    """
+    if isinstance(thing, LazyNode):
+        return thing
+    if isLazy(thing):
+        key = (_force, id(thing))
+    elif type(thing) in _valueTypes:
+        #repr, so that 0.0 and -0.0, or 1 and True, stay apart.
+        key = (None, type(thing), repr(thing))
+    else:
+        key = (None, id(thing))
+    node = _nodes.get(key)
+    if node is None:
+        if key[0] is None:
+            node = LazyNode(None, (thing,), thing)
+        else:
+            node = LazyNode(_force, (thing,))
+        _nodes[key] = node
+    return node
+
+
 class LazySequence(Lazy):
     """
     Abstract base class for lazy sequences.
@@ -836,7 +1407,7 @@ def lazyreduce(func, seq):
     """
     if isinstance(seq, LazyTuple) and not seq.isTerminating():
         raise RuntimeError, "Cannot reduce infinite tuple."
-    return LazyExpr("reduce(func, tuple(seq))")
+    return LazyExpr("reduce(func, tuple(seq))", capture = 1)
 
 def lazyzip(*seqs):
     """
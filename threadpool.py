@@ -23,31 +23,66 @@ threads. After creating an instance of ThreadPool, one queues functions to be
 excecuted. The pool dispatches the functions to the waiting threads, which
 call them.
 
-When queueing a function on the pool with *pool*.put(), an instance
-of ReturnValue is returned. ReturnValue is a subclass of lazy.Lazy, and
-can be used in any context that a regular lazy expression can. When evaluating
-a ReturnValue, the evaluating thread will block until the other thread has
+When queueing a function on the pool with *pool*.put(), an instance of
+ReturnValue is returned. ReturnValue is a subclass of lazy.Lazy, and can be
+used in any context that a regular lazy expression can. When evaluating a
+ReturnValue, the evaluating thread will block until the other thread has
 completed its work and loaded the return value of the function into the
-ReturnValue instance.
+ReturnValue instance. Jobs can be given a timeout, withdrawn with
+ReturnValue.cancel, and can poll a CancelToken to stop early once their result
+is no longer wanted. A pool is stopped with shutdown, which can cancel the jobs
+that have not started yet and wait for the threads to exit. Its getStats method
+returns a PoolStats object recording queue wait and run time histograms, job
+counts and utilization. ReturnValue.asFuture hands values to asyncio (or
+trollius) coroutines, and AsyncioPool lets coroutines submit jobs to a pool and
+stream their results. TaskGraph runs a graph of dependent jobs, each as soon as
+its inputs are ready. Batches of jobs can be queued at once with put_many, or
+spread over the pool with map and imap_unordered. ProcessPool offers the same
+interface using worker processes instead of threads. ReturnValue.eval accepts
+an optional timeout, and done() and wait_many() allow checking on results
+without blocking forever.
 
 VLocks are an alternative to RLocks which include a visible queue threads waiting
 for the lock.
 
 lock, unlock, getLockFor, and deleteLockFor work with a module-level
-dictionary of objects to locks, and can be more convenient than working with
+LockRegistry of objects to locks, and can be more convenient than working with
 lock objects directly.
 
 Locked and Async are callable wrappers around a function. Async calls return
 immediately after queueing their function on a thread pool, while Locked calls
 first acquire the lock they were passed on creation, call their function, and
-release the lock.
+release the lock. ReadLocked and WriteLocked do the same with an RWLock, for
+data which is read much more often than it is written. CopyOnWrite lets readers
+go without any lock at all.
 
 """
+import thread
 import threading
 import time
 import sys
+import math
+import traceback
+import copy
+import cPickle
 import lazy
 import Queue
+import random
+import heapq
+import weakref
+from functools import partial
+from collections import deque, OrderedDict
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
 __version__ = "1.0.1"
 
@@ -60,14 +95,42 @@ class Worker(threading.Thread):
     callbacks, arbitrary error reporting, etc.
     """
     def __init__(self, getJobFunc, group = None, name = None,
-                 exitFunc = None, trap_errors = 0):
+                 exitFunc = None, trap_errors = 0, reportFunc = None,
+                 initializer = None, finalizer = None, errorFunc = None,
+                 helpFunc = None):
+        """
+        Any exception a job raises, not only StandardErrors, is caught and
+        loaded into the job's ReturnValue along with its traceback, and the
+        thread carries on. If *errorFunc* is given, it is also called with
+        the job and the sys.exc_info() triple.
+
+        If *reportFunc* is given, it is called after each job with the
+        number of seconds the job ran for, and 1 if it raised an exception,
+        0 otherwise.
+
+        If *initializer* is given, the thread calls it once when it starts,
+        and keeps what it returns as its resource (see getResource) for all
+        the jobs it runs. If *finalizer* is given, the thread calls it with
+        the resource as it exits.
+
+        If *helpFunc* is given, ReturnValue.wait and eval call it, with the
+        value's completion signal and the timeout, when this thread waits on
+        a value, so that the thread can run other jobs in the meantime.
+        """
         threading.Thread.__init__(self, group = group, name = name)
         self._getJob = getJobFunc
+        self._report = reportFunc
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._errorFunc = errorFunc
+        self._resource = None
+        self._resourceError = None
         self._busy = 0
         self._error = 0
         self._job = None
         self._ignore_error = trap_errors
         self._exitFunc = exitFunc
+        self._helpFunc = helpFunc
 
     def isBusy(self):
         return self._busy
@@ -78,35 +141,215 @@ class Worker(threading.Thread):
     def getAssociatedValue(self):
         return self._job[2]    
 
+    def getResource(self):
+        """
+        Returns this thread's resource, which jobs can use to keep expensive
+        per-thread state (connections, parsers, buffers) between jobs. Jobs
+        reach it with threading.currentThread().getResource(). If the
+        initializer failed, its exception is raised here instead.
+        """
+        if self._resourceError is not None:
+            raise self._resourceError
+        return self._resource
+
+    def setResource(self, resource):
+        """
+        Replaces this thread's resource. The finalizer, if any, is only
+        called on the resource the thread has when it exits.
+        """
+        self._resource = resource
+        self._resourceError = None
+
     def run(self):
+        if self._initializer:
+            try:
+                self._resource = self._initializer()
+            except:
+                self._resourceError = sys.exc_info()[1]
+        try:
+            self._work()
+        finally:
+            if self._finalizer and self._resourceError is None:
+                self._finalizer(self._resource)
+            if self._exitFunc:
+                self._exitFunc()
+
+    def _work(self):
         while 1:
             self._busy = 0
             job = self._getJob()
-            #Jobs are 2-tuples with the function to call in the first
-            #position, and the ReturnValue instance in the second.
-            self._busy = 1
-            self._job = job
+            #Jobs are 7-tuples with the function to call in the first
+            #position, the ReturnValue instance in the second, the associated
+            #value in the third, the deadline in the fourth, the time it
+            #was queued in the fifth, its priority in the sixth, and its
+            #rate limiting key in the seventh.
             if not job[0]:
                 #We treat an empty job as a command to terminate.
                 #if job[1] would call __nonzero__ on ReturnValue, which would
                 #cause a deadlock as it tried to eval() the unloaded ReturnValue.
+                self._busy = 1
+                self._job = job
                 if not job[1] is None:
                     job[1].load(None)
                 return
-            else:
-                try:
-                    val = job[0]()
-                    asException = 0
-                except StandardError, e:
-                    val = e
-                    asException = 1
-                    #if job[1] would call __nonzero__ on ReturnValue, which would
-                    #cause a deadlock as it tried to eval() the unloaded ReturnValue.
-                if not job[1] is None:
-                    job[1].load(val, asException = asException)
-            self._job = None
-        if self._exitFunc:
-            self._exitFunc()
+            self._runJob(job)
+
+    def _runJob(self, job):
+        """
+        Runs *job* and loads its result. Called from _work, and from the
+        help function while this thread waits on a value, in which case the
+        job being waited in is restored afterwards.
+        """
+        outer = self._job
+        self._busy = 1
+        self._job = job
+        started = time.time()
+        tb = None
+        try:
+            val = job[0]()
+            asException = 0
+        except:
+            excInfo = sys.exc_info()
+            val, tb = excInfo[1], excInfo[2]
+            asException = 1
+            if self._errorFunc:
+                self._reportError(job, excInfo)
+            del excInfo
+        if self._report:
+            self._report(time.time() - started, asException)
+        #if job[1] would call __nonzero__ on ReturnValue, which would
+        #cause a deadlock as it tried to eval() the unloaded ReturnValue.
+        if not job[1] is None:
+            job[1].load(val, asException = asException, tb = tb)
+        #Don't keep the last job's frames alive while waiting.
+        val = tb = None
+        self._job = outer
+
+    def _reportError(self, job, excInfo):
+        #The error hook must not be able to kill the worker either.
+        try:
+            self._errorFunc(job, excInfo)
+        except:
+            traceback.print_exc()
+
+
+class TimeoutError(RuntimeError):
+    """
+    Raised by ReturnValue.eval when a timeout is given and the value has not
+    been loaded before it expires.
+    """
+    pass
+
+
+class CancelledError(RuntimeError):
+    """
+    Raised by ReturnValue.eval when the job was cancelled before it ran, and
+    by CancelToken.check when cancellation has been requested.
+    """
+    pass
+
+
+class CancelToken:
+    """
+    A flag which a running job can poll to find out whether its result is
+    still wanted. ReturnValue.cancel and put timeouts set it; the job finds
+    its token with getCancelToken(), and either polls isCancelled or calls
+    check at convenient points.
+    """
+    def __init__(self):
+        self._cancelled = 0
+
+    def cancel(self):
+        self._cancelled = 1
+
+    def isCancelled(self):
+        return self._cancelled
+
+    def check(self):
+        """
+        Raises CancelledError if cancellation has been requested.
+        """
+        if self._cancelled:
+            raise CancelledError, "The job was cancelled."
+
+
+def getCancelToken():
+    """
+    Returns the CancelToken of the job the current thread is running, or None
+    if the current thread is not running a pool job.
+    """
+    worker = threading.currentThread()
+    job = getattr(worker, '_job', None)
+    if not isinstance(worker, Worker) or not job or job[1] is None:
+        return None
+    return job[1].getCancelToken()
+
+
+class _Completion:
+    """
+    A one-shot completion signal. The gate lock is taken when the signal is
+    created and released exactly once by set(), so a waiter that arrives
+    before or after set() can never miss the wakeup. Waiters pass through
+    the gate by acquiring and immediately releasing it, which wakes the
+    next waiter in turn.
+    """
+    def __init__(self):
+        self._gate = thread.allocate_lock()
+        self._gate.acquire()
+        self._set = 0
+
+    def isSet(self):
+        return self._set
+
+    def set(self):
+        self._set = 1
+        self._gate.release()
+
+    def wait(self, timeout = None):
+        """
+        Blocks until set() has been called, or *timeout* seconds have passed.
+        Returns 1 if the signal was set, 0 on timeout.
+        """
+        if self._set:
+            return 1
+        if _acquireLock(self._gate, timeout):
+            self._gate.release()
+            return 1
+        return 0
+
+
+def _waitFor(completion, timeout = None):
+    """
+    Waits on a ReturnValue's *completion* signal. A work-stealing worker
+    runs queued jobs while it waits instead, so that a job which waits on
+    jobs it queued itself can't deadlock the pool.
+    """
+    if not completion.isSet():
+        worker = threading.currentThread()
+        if isinstance(worker, Worker) and worker._helpFunc is not None:
+            return worker._helpFunc(completion, timeout)
+    return completion.wait(timeout)
+
+def _acquireLock(lock, timeout = None):
+    """
+    Acquires the primitive *lock*, waiting at most *timeout* seconds if that
+    is not None. Returns 1 if the lock was acquired, 0 otherwise.
+    """
+    if timeout is None:
+        lock.acquire()
+        return 1
+    #Lock.acquire takes no timeout, so poll with a backoff, as
+    #threading.Condition.wait does.
+    endtime = time.time() + timeout
+    delay = 0.0005
+    while 1:
+        if lock.acquire(0):
+            return 1
+        remaining = endtime - time.time()
+        if remaining <= 0:
+            return 0
+        delay = min(delay * 2, remaining, .05)
+        time.sleep(delay)
 
 
 class ReturnValue(lazy.LazyExpr):
@@ -114,33 +357,333 @@ class ReturnValue(lazy.LazyExpr):
     A lazy return value. Calls to eval block until the value is loaded,
     but the ReturnValue instance can be stored or passed to other
     functions in the meantime.
+
+    Work which depends on the value can be chained on with then and catch
+    rather than by calling eval, so no thread has to wait for it:
+
+    >>> total = pool.put(fetch).then(parse).then(summarize).catch(report)
     """
-    def __init__(self):
-        pass
-
-    def eval(self):
-        if not self.__dict__.has_key("_value"):
-            self.__dict__['_condition'] = threading.Condition()
-            self._condition.acquire()
-            self._condition.wait()
-            self._condition.release()
-        if self.__dict__['_asException']:
-            raise self._value
+    def __init__(self, pool = None):
+        """
+        *pool* is the ThreadPool which continuations added with then and
+        catch are queued on. Without one, they run in the thread which loads
+        the value.
+        """
+        self.__dict__['_completion'] = _Completion()
+        self.__dict__['_pool'] = pool
+
+    def done(self):
+        """
+        Returns 1 if the value has been loaded, 0 otherwise. Never blocks.
+        """
+        return self.__dict__['_completion'].isSet()
+
+    isEvaluated = done
+
+    def wait(self, timeout = None):
+        """
+        Blocks until the value is loaded or *timeout* seconds have passed,
+        without raising any exception the job produced. Returns 1 if the
+        value is loaded, 0 otherwise.
+        """
+        return _waitFor(self.__dict__['_completion'], timeout)
+
+    def eval(self, timeout = None):
+        """
+        Returns the loaded value, blocking until it is available. If the job
+        raised an exception, it is raised again here. If *timeout* is given
+        and expires first, raises TimeoutError.
+        """
+        if not _waitFor(self.__dict__['_completion'], timeout):
+            raise TimeoutError, "Value not loaded within %s seconds." % timeout
+        val, asException = self.__dict__['_result']
+        if asException:
+            tb = self.__dict__.get('_traceback')
+            if tb is not None:
+                raise val, None, tb
+            raise val
+        else:
+            return val
+
+    def getCancelToken(self):
+        """
+        Returns the CancelToken for this value's job.
+        """
+        #setdefault, so racing callers all get the same token.
+        return self.__dict__.setdefault('_token', CancelToken())
+
+    def _claim(self):
+        """
+        Claims the right to start, cancel or expire the job, returning 1 for
+        the first claimant and 0 for everyone after.
+        """
+        mine = []
+        return self.__dict__.setdefault('_claimed', mine) is mine
+
+    def cancel(self):
+        """
+        Cancels the job if it has not started yet, so that it never runs and
+        eval raises CancelledError; returns 1 if so. A job waiting in the
+        pool's shared queue is taken off it, making room for another. If it has started, asks
+        it to stop through its CancelToken, and returns 0; its result is
+        still loaded as usual.
+        """
+        if self._claim():
+            self._withdraw()
+            pool = self.__dict__['_pool']
+            if pool is not None:
+                pool._stats.count('cancelled')
+            self.load(CancelledError("The job was cancelled."), asException = 1)
+            return 1
+        if not self.done():
+            self.getCancelToken().cancel()
+        return 0
+
+    def _withdraw(self):
+        #Takes the job off its pool's shared queue, if it is waiting there.
+        queue = self.__dict__.get('_queuedIn')
+        if queue is not None:
+            queue._withdraw(self)
+
+    def _expireAt(self, when, timeout):
+        """
+        Arranges for _expire to be called at *when*, unless the value is
+        loaded first.
+        """
+        self.__dict__['_expiry'] = _timer.schedule(when, partial(self._expire, timeout))
+        if self.done():
+            self._dropExpiry()
+
+    def _dropExpiry(self):
+        #dict.pop is atomic, so the timer entry is cancelled only once.
+        entry = self.__dict__.pop('_expiry', None)
+        if entry is not None:
+            _timer.cancel(entry)
+
+    def _expire(self, timeout):
+        """
+        Called when a put timeout runs out. Fails the value with TimeoutError
+        unless it is already loaded, and asks a running job to stop.
+        """
+        if self.done():
+            return
+        if self._claim():
+            self._withdraw()
+            pool = self.__dict__['_pool']
+            if pool is not None:
+                pool._stats.count('expired')
         else:
-            return self._value
+            self.getCancelToken().cancel()
+        self.load(TimeoutError("Job not finished within %s seconds." % timeout),
+                  asException = 1)
+
+    def getTraceback(self):
+        """
+        Returns the traceback of the exception the job raised, if it raised
+        one and it was captured, and None otherwise.
+        """
+        return self.__dict__.get('_traceback')
+
+    def load(self, val, asException = 0, tb = None):
+        """
+        Loads the value and wakes all waiters. Only the first load counts;
+        returns 1 if this call loaded the value, 0 if it was already loaded.
+        If *asException* is true, *val* is an exception for eval to raise,
+        with the traceback *tb* if that is given.
+        """
+        result = (val, asException)
+        #dict.setdefault is atomic, so exactly one loader wins.
+        if self.__dict__.setdefault('_result', result) is not result:
+            return 0
+        if tb is not None:
+            self.__dict__['_traceback'] = tb
+        self.__dict__['_completion'].set()
+        self._dropExpiry()
+        _callbackLock.acquire()
+        try:
+            callbacks = self.__dict__.get('_callbacks')
+            self.__dict__['_callbacks'] = None
+        finally:
+            _callbackLock.release()
+        if callbacks:
+            for callback in callbacks:
+                #A failing callback must not take the loading thread with it.
+                try:
+                    callback(self)
+                except:
+                    traceback.print_exc()
+        return 1
+
+    def addCallback(self, callback):
+        """
+        Arranges for *callback* to be called with this ReturnValue once it is
+        loaded: by the thread which loads it, or immediately by this thread if
+        it is already loaded. Callbacks should be quick, since they run on
+        the pool's workers.
+        """
+        _callbackLock.acquire()
+        try:
+            callbacks = self.__dict__.get('_callbacks', [])
+            if callbacks is not None:
+                callbacks.append(callback)
+                self.__dict__['_callbacks'] = callbacks
+        finally:
+            _callbackLock.release()
+        if callbacks is None:
+            callback(self)
+
+    def then(self, func):
+        """
+        Returns a new ReturnValue for func(*value*). Once this value is
+        loaded, the call is queued on this value's pool. If the job raised
+        an exception instead, *func* is not called, and the new ReturnValue
+        raises the same exception.
+        """
+        nextRv = ReturnValue(self.__dict__['_pool'])
+        self.addCallback(lambda rv, nextRv = nextRv, func = func:
+                         rv._continue(nextRv, func, 0))
+        return nextRv
+
+    def catch(self, func):
+        """
+        Returns a new ReturnValue for func(*exception*), queued on this
+        value's pool if the job raised *exception*. If it didn't, *func* is
+        not called, and the new ReturnValue gets the same value as this one.
+        """
+        nextRv = ReturnValue(self.__dict__['_pool'])
+        self.addCallback(lambda rv, nextRv = nextRv, func = func:
+                         rv._continue(nextRv, func, 1))
+        return nextRv
+
+    def _continue(self, nextRv, func, onException):
+        val, asException = self.__dict__['_result']
+        if (not asException) != (not onException):
+            nextRv.load(val, asException = asException, tb = self.getTraceback())
+            return
+        job = partial(func, val)
+        pool = nextRv.__dict__['_pool']
+        if pool is not None:
+            #Never block a worker on its own full queue; if there's no room,
+            #run the continuation here instead.
+            try:
+                pool._queueJob(job, nextRv, block = 0)
+                return
+            except Queue.Full:
+                pass
+            except RuntimeError, e:
+                #The pool has been shut down; while it drains, continuations
+                #of the jobs it had already accepted still run on it.
+                if not pool._queueContinuation(job, nextRv):
+                    nextRv.load(e, asException = 1)
+                return
+        try:
+            nextRv.load(job())
+        except:
+            excInfo = sys.exc_info()
+            nextRv.load(excInfo[1], asException = 1, tb = excInfo[2])
 
-    def load(self, val, asException = 0):
-        self.__dict__['_asException'] = asException
-        self.__dict__['_value'] = val
-        if self.__dict__.has_key("_condition"):
-            self._condition.acquire()
-            self._condition.notifyAll()
-            self._condition.release()
+    def asFuture(self, loop = None):
+        """
+        Returns an asyncio Future, belonging to *loop* (or the current event
+        loop), which completes with this value once it is loaded. The Future
+        is completed through loop.call_soon_threadsafe, so no thread is
+        blocked waiting for it.
+        """
+        if asyncio is None:
+            raise RuntimeError, "asFuture requires the asyncio module."
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = _newFuture(loop)
+        def settle(rv, future = future, loop = loop):
+            loop.call_soon_threadsafe(_settleFuture, future, rv)
+        self.addCallback(settle)
+        return future
 
     def __repr__(self):
         return "<ReturnValue instance at " + str(hex(id(self))) + ">"
 
 
+#Guards the callback lists of all ReturnValues. It is only held long enough
+#to swap a list, so one lock serves them all.
+_callbackLock = thread.allocate_lock()
+
+def _newFuture(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop = loop)
+
+def _settleFuture(future, rv):
+    """
+    Copies the value loaded into *rv* to the asyncio Future *future*. Runs on
+    the future's event loop.
+    """
+    if future.cancelled():
+        return
+    val, asException = rv.__dict__['_result']
+    if asException:
+        future.set_exception(val)
+    else:
+        future.set_result(val)
+
+
+def gather(*values):
+    """
+    Returns a ReturnValue which is loaded with a list of the values of the
+    given ReturnValues, in order, once they are all loaded. If any of them
+    raised an exception, it is loaded with the first such exception instead.
+    No thread waits while the values are computed. Continuations added to
+    the result with then or catch are queued on the first value's pool.
+    """
+    if not values:
+        result = ReturnValue()
+        result.load([])
+    else:
+        result = ReturnValue(values[0].__dict__['_pool'])
+        _Gatherer(values, result)
+    return result
+
+class _Gatherer:
+    """
+    Collects the values for gather as they are loaded.
+    """
+    def __init__(self, values, result):
+        self._result = result
+        self._values = [None] * len(values)
+        self._remaining = len(values)
+        self._lock = thread.allocate_lock()
+        for i in xrange(len(values)):
+            values[i].addCallback(lambda rv, i = i, self = self: self._loaded(i, rv))
+
+    def _loaded(self, i, rv):
+        val, asException = rv.__dict__['_result']
+        if asException:
+            self._result.load(val, asException = 1, tb = rv.getTraceback())
+            return
+        self._lock.acquire()
+        self._values[i] = val
+        self._remaining = self._remaining - 1
+        finished = not self._remaining
+        self._lock.release()
+        if finished:
+            self._result.load(self._values)
+
+
+def wait_many(values, timeout = None):
+    """
+    Blocks until every ReturnValue in *values* is loaded, or until *timeout*
+    seconds have passed. Returns a list of the values that are loaded, in the
+    order given.
+    """
+    if timeout is not None:
+        endtime = time.time() + timeout
+    for rv in values:
+        if timeout is None:
+            rv.wait()
+        elif not rv.wait(max(endtime - time.time(), 0)):
+            break
+    return filter(lambda rv: rv.done(), values)
+
+
 
 class Async:
     """
@@ -160,13 +703,38 @@ class Async:
     <ReturnValue instance at 0x7c08d0>
     >>> <Worker(Thread Pool - 1, started)>
 
+    Arguments are passed on to the function. If *max_in_flight* is given,
+    at most that many calls may be queued or running at once; further calls
+    block until one of them finishes, so one busy function can't flood a
+    shared pool.
     """
-    def __init__(self, func, pool):
+    def __init__(self, func, pool, max_in_flight = None):
         self._func = func
         self._pool  = pool
+        if max_in_flight:
+            self._slots = threading.BoundedSemaphore(max_in_flight)
+        else:
+            self._slots = None
 
     def __call__(self, *args, **kwargs):
-        return self._pool.put(self._func)
+        if args or kwargs:
+            #partial is implemented in C, and is cheaper than a closure.
+            job = partial(self._func, *args, **kwargs)
+        else:
+            job = self._func
+        if self._slots is None:
+            return self._pool.put(job)
+        self._slots.acquire()
+        try:
+            rv = self._pool.put(job)
+        except:
+            self._slots.release()
+            raise
+        rv.addCallback(self._finished)
+        return rv
+
+    def _finished(self, rv):
+        self._slots.release()
 
 
 class Locked:
@@ -181,19 +749,205 @@ class Locked:
     def __call__(self, *args, **kwargs):
         self._lock.acquire()
         try:
-            apply(self._func, args, kwargs)
+            return apply(self._func, args, kwargs)
         finally:
             self._lock.release()
 
+class ReadLocked:
+    """
+    Like Locked, but holds an RWLock for reading during the call, so any
+    number of ReadLocked calls may run at once.
+    """
+    def __init__(self, func, lock):
+        self._func = func
+        self._lock = lock
+    def __call__(self, *args, **kwargs):
+        self._lock.acquireRead()
+        try:
+            return apply(self._func, args, kwargs)
+        finally:
+            self._lock.releaseRead()
+
+class WriteLocked:
+    """
+    Like Locked, but holds an RWLock for writing during the call, excluding
+    both ReadLocked and WriteLocked calls which use the same lock.
+    """
+    def __init__(self, func, lock):
+        self._func = func
+        self._lock = lock
+    def __call__(self, *args, **kwargs):
+        self._lock.acquireWrite()
+        try:
+            return apply(self._func, args, kwargs)
+        finally:
+            self._lock.releaseWrite()
+
+class RWLock:
+    """
+    A reader-writer lock: any number of threads may hold it for reading at
+    once, or one thread for writing. Writers are preferred; once a writer
+    is waiting, threads which don't already hold the lock for reading wait
+    behind it, so a steady stream of readers can't starve writers.
+
+    The writer may acquire the lock again for reading or writing. A reader
+    may upgrade by calling acquireWrite; it keeps its read hold, so after
+    releaseWrite it is a reader again. Only one thread can wait to upgrade
+    at a time, since two would wait for each other forever; a second one
+    gets a RuntimeError.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writerLocks = 0
+        self._writersWaiting = 0
+        self._upgrading = None
+
+    def getReaders(self):
+        return self._readers.keys()
+
+    def getWriter(self):
+        return self._writer
+
+    def acquireRead(self):
+        me = threading.currentThread()
+        self._cond.acquire()
+        try:
+            if not (self._writer is me or self._readers.has_key(me)):
+                while self._writer is not None or self._writersWaiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        finally:
+            self._cond.release()
+
+    def releaseRead(self):
+        me = threading.currentThread()
+        self._cond.acquire()
+        try:
+            count = self._readers.get(me)
+            if not count:
+                raise RuntimeError, "Cannot release a read lock this thread does not hold."
+            if count == 1:
+                del self._readers[me]
+                self._cond.notifyAll()
+            else:
+                self._readers[me] = count - 1
+        finally:
+            self._cond.release()
+
+    def acquireWrite(self):
+        me = threading.currentThread()
+        self._cond.acquire()
+        try:
+            if self._writer is me:
+                self._writerLocks = self._writerLocks + 1
+                return
+            upgrading = self._readers.has_key(me)
+            if upgrading:
+                if self._upgrading is not None:
+                    raise RuntimeError, "Another reader is already upgrading this lock."
+                self._upgrading = me
+            self._writersWaiting = self._writersWaiting + 1
+            try:
+                while self._writer is not None or \
+                      len(self._readers) > upgrading:
+                    self._cond.wait()
+            finally:
+                self._writersWaiting = self._writersWaiting - 1
+                if upgrading:
+                    self._upgrading = None
+            self._writer = me
+            self._writerLocks = 1
+        finally:
+            self._cond.release()
+
+    def releaseWrite(self):
+        self._cond.acquire()
+        try:
+            if self._writer is not threading.currentThread():
+                raise RuntimeError, "Cannot release a write lock this thread does not hold."
+            self._writerLocks = self._writerLocks - 1
+            if not self._writerLocks:
+                self._writer = None
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+class CopyOnWrite:
+    """
+    Holds a value which readers can use without taking any lock: get returns
+    the current version, which is never modified in place. Writers go
+    through update, which applies a function to a copy of the value and then
+    publishes the copy, one writer at a time. Suits read-mostly data, such
+    as caches, where copying on each write is cheaper than locking on each
+    read.
+    """
+    def __init__(self, value, copier = copy.copy):
+        self._value = value
+        self._copier = copier
+        self._writeLock = thread.allocate_lock()
+
+    def get(self):
+        return self._value
+
+    def update(self, func, *args, **kwargs):
+        """
+        Calls *func* with a copy of the current value and any further
+        arguments, publishes the copy, and returns what *func* returned. If
+        *func* raises an exception, the copy is discarded.
+        """
+        self._writeLock.acquire()
+        try:
+            new = self._copier(self._value)
+            result = func(new, *args, **kwargs)
+            self._value = new
+            return result
+        finally:
+            self._writeLock.release()
+
+    def set(self, value):
+        """
+        Publishes *value* as the new version.
+        """
+        self._writeLock.acquire()
+        self._value = value
+        self._writeLock.release()
+
+
 class VLock:
     """
     Similar to an RLock, but with a (V)isible queue of waiting threads.
+
+    The owning thread may acquire it again, and must release it as many
+    times. Waiting threads are served in the order they arrived: release
+    hands the lock straight to the thread at the head of the queue, so a
+    newcomer can't barge in ahead of it. getStats reports how often the lock
+    was contended and how long it was held.
+
+    A thread waiting with a timeout has to poll, so the lock is never handed
+    to one; it would sit idle until the thread next looked. Such threads
+    are passed over for threads waiting without a timeout, and when only
+    they are left, release frees the lock and wakes them all to contend for
+    it.
     """
     def __init__(self):
-        self.lock = threading.Lock()
+        self._mutex = thread.allocate_lock()
         self.owner = None
-        self.queue = []
+        #Maps each waiting thread's gate lock to the thread, in arrival order,
+        #so a thread which times out can leave the queue in constant time.
+        self.queue = OrderedDict()
+        #The gates of the threads in the queue which wait with a timeout.
+        self._timed = {}
         self.ownerlocks = 0
+        self._acquiredAt = 0.0
+        self._acquisitions = 0
+        self._contended = 0
+        self._timeouts = 0
+        self._waitTime = 0.0
+        self._holdTime = 0.0
+        self._maxHold = 0.0
 
     def isLocked(self):
         return not self.owner is None
@@ -202,49 +956,238 @@ class VLock:
         return self.owner
 
     def getWaiting(self):
-        return self.queue
+        """
+        Returns a list of the threads waiting for this lock, in the order
+        they will get it.
+        """
+        self._mutex.acquire()
+        try:
+            return self.queue.values()
+        finally:
+            self._mutex.release()
+
+    def getStats(self):
+        """
+        Returns a dictionary with the number of times the lock was taken
+        ('acquisitions'), the number of those which had to wait
+        ('contended'), the number of waits which timed out ('timeouts'), and
+        the total time spent waiting ('waitTime'), the total time it was
+        held ('holdTime') and the longest single hold ('maxHold'), in seconds.
+        """
+        self._mutex.acquire()
+        try:
+            return {'acquisitions': self._acquisitions,
+                    'contended': self._contended,
+                    'timeouts': self._timeouts,
+                    'waitTime': self._waitTime,
+                    'holdTime': self._holdTime,
+                    'maxHold': self._maxHold}
+        finally:
+            self._mutex.release()
 
-    def acquire(self, blocking = 1):
-        thread = threading.currentThread()
-        self.queue.append(thread)
-        self.lock.acquire(blocking)
-        self.queue.remove(thread)
-        self.ownerlocks = self.ownerlocks + 1
-        self.owner = thread
+    def _take(self, owner):
+        #Called with the mutex held. The new owner records when it got the
+        #lock itself, once it is through its gate.
+        self.owner = owner
+        self.ownerlocks = 1
+        self._acquisitions = self._acquisitions + 1
+
+    def acquire(self, blocking = 1, timeout = None):
+        """
+        Acquires the lock, returning 1 if it was acquired and 0 otherwise. If
+        *blocking* is false, returns at once; otherwise waits, for at most
+        *timeout* seconds if that is given.
+        """
+        me = threading.currentThread()
+        mutex = self._mutex
+        mutex.acquire()
+        if self.owner is me:
+            self.ownerlocks = self.ownerlocks + 1
+            mutex.release()
+            return 1
+        if self.owner is None and not self.queue:
+            self._take(me)
+            self._acquiredAt = time.time()
+            mutex.release()
+            return 1
+        if not blocking:
+            mutex.release()
+            return 0
+        gate = thread.allocate_lock()
+        gate.acquire()
+        self.queue[gate] = me
+        if timeout is not None:
+            self._timed[gate] = 1
+        self._contended = self._contended + 1
+        mutex.release()
+        started = time.time()
+        while 1:
+            if timeout is None:
+                acquired = _acquireLock(gate)
+            else:
+                acquired = _acquireLock(gate, started + timeout - time.time())
+            mutex.acquire()
+            try:
+                #A timed waiter which release has woken is no longer queued,
+                #and takes the lock if nobody beat it there.
+                if self.owner is None and not self.queue.has_key(gate):
+                    self._take(me)
+                if self.owner is me:
+                    self._acquiredAt = time.time()
+                    self._waitTime = self._waitTime + (self._acquiredAt - started)
+                    return 1
+                if self.queue.has_key(gate):
+                    del self.queue[gate]
+                    del self._timed[gate]
+                    self._timeouts = self._timeouts + 1
+                    return 0
+                #Woken, but beaten to the lock: queue again for what is left
+                #of the timeout.
+                if not acquired:
+                    gate.acquire()
+                if time.time() - started >= timeout:
+                    self._timeouts = self._timeouts + 1
+                    return 0
+                self.queue[gate] = me
+                self._timed[gate] = 1
+            finally:
+                mutex.release()
 
     def release(self):
-        assert threading.currentThread() == self.owner
-        self.ownerlocks = self.ownerlocks - 1
-        if self.ownerlocks == 0:
+        """
+        Releases one level of ownership. Returns 1 if the lock is now free
+        (or handed to the next waiting thread), 0 if this thread still owns
+        it.
+        """
+        self._mutex.acquire()
+        try:
+            if self.owner is not threading.currentThread():
+                raise RuntimeError, "Cannot release a VLock this thread does not own."
+            self.ownerlocks = self.ownerlocks - 1
+            if self.ownerlocks:
+                return 0
+            held = time.time() - self._acquiredAt
+            self._holdTime = self._holdTime + held
+            if held > self._maxHold:
+                self._maxHold = held
+            if not self._timed:
+                if self.queue:
+                    gate, waiter = self.queue.popitem(last = 0)
+                    self._take(waiter)
+                    gate.release()
+                else:
+                    self.owner = None
+                return 1
+            for gate, waiter in self.queue.iteritems():
+                if not self._timed.has_key(gate):
+                    del self.queue[gate]
+                    self._take(waiter)
+                    gate.release()
+                    return 1
             self.owner = None
-            self.lock.release()
+            for gate in self._timed.keys():
+                del self.queue[gate]
+                gate.release()
+            self._timed.clear()
             return 1
-        else:
-            return 0
+        finally:
+            self._mutex.release()
 
     def __str__(self):
-        return "<VLock owner = " + str(self.owner) + " waiting = " + str(self.queue) + " >"
+        return "<VLock owner = " + str(self.owner) + " waiting = " + str(self.getWaiting()) + " >"
+
+
+class LockRegistry:
+    """
+    Associates VLocks with arbitrary objects. The registry is split into
+    *shards* independently locked tables, chosen by the object's hash, so
+    lookups are thread-safe without all going through one lock. Objects
+    which support weak references are held weakly, and their locks vanish
+    with them; other objects (numbers, strings, tuples) are held until
+    delete is called, as before.
+
+    If *stripes* is given, no table is kept at all: the registry is a fixed
+    pool of that many VLocks, and an object's lock is chosen by its hash.
+    Memory use is then constant, at the cost of unrelated objects sometimes
+    sharing a lock, so code which holds locks on two objects at once must
+    always take them in the same order.
+    """
+    def __init__(self, shards = 16, stripes = 0):
+        if stripes:
+            self._stripes = map(lambda i: VLock(), range(stripes))
+        else:
+            self._stripes = None
+        self._shards = map(lambda i: (thread.allocate_lock(),
+                                      weakref.WeakKeyDictionary(), {}),
+                           range(shards))
+
+    def get(self, object, create = 1):
+        """
+        Returns the VLock associated with *object*. If there is none, creates
+        one if *create* is true, and otherwise returns None.
+        """
+        if self._stripes is not None:
+            return self._stripes[hash(object) % len(self._stripes)]
+        guard, weak, strong = self._shards[hash(object) % len(self._shards)]
+        guard.acquire()
+        try:
+            try:
+                table = weak
+                lock = weak.get(object)
+            except TypeError:
+                #Not weakly referenceable.
+                table = strong
+                lock = strong.get(object)
+            if lock is None and create:
+                lock = table[object] = VLock()
+            return lock
+        finally:
+            guard.release()
+
+    def delete(self, object):
+        """
+        Forgets the VLock associated with *object*, if there is one.
+        """
+        if self._stripes is not None:
+            return
+        guard, weak, strong = self._shards[hash(object) % len(self._shards)]
+        guard.acquire()
+        try:
+            try:
+                del weak[object]
+            except (KeyError, TypeError):
+                strong.pop(object, None)
+        finally:
+            guard.release()
 
+    def __len__(self):
+        if self._stripes is not None:
+            return len(self._stripes)
+        return reduce(lambda total, shard: total + len(shard[1]) + len(shard[2]),
+                      self._shards, 0)
 
-_locks = {}
+
+_registry = LockRegistry()
+
+def setLockRegistry(registry):
+    """
+    Replaces the LockRegistry used by getLockFor, deleteLockFor, lock and
+    unlock, for instance with a striped one.
+    """
+    global _registry
+    _registry = registry
 
 def getLockFor(object):
     """
     Returns a VLock associated with the object, creating one if necessary.
     """
-    if not _locks.has_key(object):
-        _locks[object] = VLock()
-    lock = _locks[object]
-    return lock
+    return _registry.get(object)
 
 def deleteLockFor(object):
     """
     Deletes the VLock associated with *object*, if one exists.
     """
-    try:
-        del _locks[object]
-    except:
-        pass
+    _registry.delete(object)
 
 def lock(object):
     """
@@ -260,31 +1203,460 @@ def unlock(object):
     Releases a held lock on an object. Every lock must be balanced by an unlock
     before any other thread may access the object.
     """
-    if not _locks.has_key(object):
+    lock = _registry.get(object, create = 0)
+    if lock is None:
         return
-    lock = _locks[object]
     lock.release()
 
 
-class ThreadPool(Queue.Queue):
+class Histogram:
     """
-    Creates and maintains a pool of threads. Jobs are queued by calling put.
+    A histogram of durations in seconds. Bucket *i* counts durations of up
+    to 2 ** *i* microseconds, so recording is cheap and percentiles are
+    estimated to within a factor of two. Not thread-safe by itself; PoolStats
+    guards its histograms with its own lock.
     """
-    def __init__(self, name = "Thread Pool", minThreads = 2, maxThreads = 10, daemon = 1):
-        Queue.Queue.__init__(self, 0)
+    def __init__(self, buckets = 32):
+        self._buckets = [0] * buckets
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, seconds):
+        micros = seconds * 1000000
+        if micros <= 1:
+            i = 0
+        else:
+            i = min(math.frexp(micros)[1], len(self._buckets) - 1)
+        self._buckets[i] = self._buckets[i] + 1
+        self._count = self._count + 1
+        self._total = self._total + seconds
+        if seconds > self._max:
+            self._max = seconds
+
+    def copy(self):
+        other = Histogram(len(self._buckets))
+        other._buckets = self._buckets[:]
+        other._count = self._count
+        other._total = self._total
+        other._max = self._max
+        return other
+
+    def percentile(self, p):
+        """
+        Returns an upper bound on the *p*th percentile (0 to 100), or 0.0
+        if nothing has been recorded.
+        """
+        if not self._count:
+            return 0.0
+        wanted = self._count * p / 100.0
+        seen = 0
+        for i in xrange(len(self._buckets)):
+            seen = seen + self._buckets[i]
+            if seen >= wanted:
+                return min((2 ** i) / 1000000.0, self._max)
+        return self._max
+
+    def summary(self):
+        """
+        Returns a dictionary with the count, mean, max and the 50th, 90th and
+        99th percentiles.
+        """
+        if self._count:
+            mean = self._total / self._count
+        else:
+            mean = 0.0
+        return {'count': self._count, 'mean': mean, 'max': self._max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter, for ThreadPool's job admission. Tokens
+    accrue at *rate* per second, up to *burst* of them (by default, a
+    second's worth, but at least one), and each job admitted takes one.
+
+    Jobs which find the bucket empty are parked on it, in the order they
+    arrived, and handed back to the pool by the timer thread as tokens
+    accrue, so they hold neither a worker nor a place in the queue while
+    they wait.
+    """
+    def __init__(self, rate, burst = None):
+        if rate <= 0:
+            raise ValueError, "rate must be more than zero."
+        self._rate = float(rate)
+        if burst is None:
+            burst = max(rate, 1)
+        self._burst = float(burst)
+        self._tokens = self._burst
+        self._stamp = time.time()
+        self._lock = thread.allocate_lock()
+        self._waiting = deque()
+        self._scheduled = 0
+        self._admitted = 0
+        self._throttled = 0
+
+    def _refill(self, now):
+        #Called with self._lock held.
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def _delay(self):
+        #Called with self._lock held: seconds until the next token.
+        return max((1 - self._tokens) / self._rate, 0)
+
+    def tryTake(self):
+        """
+        Takes a token and returns 1 if one is available, otherwise returns 0.
+        """
+        self._lock.acquire()
+        try:
+            self._refill(time.time())
+            if self._tokens >= 1:
+                self._tokens = self._tokens - 1
+                self._admitted = self._admitted + 1
+                return 1
+            return 0
+        finally:
+            self._lock.release()
+
+    def _admit(self, job, stage, release):
+        """
+        Takes a token for *job* and returns 1, or parks the job and returns
+        0. Parked jobs are passed to *release* with their *stage* once they
+        have their token. A job never overtakes one parked before it.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            if not self._waiting and self._tokens >= 1:
+                self._tokens = self._tokens - 1
+                self._admitted = self._admitted + 1
+                return 1
+            self._waiting.append((job, stage))
+            self._throttled = self._throttled + 1
+            if not self._scheduled:
+                self._scheduled = 1
+                _timer.schedule(now + self._delay(), partial(self._release, release))
+            return 0
+        finally:
+            self._lock.release()
+
+    def _release(self, release):
+        #Called on the timer thread.
+        ready = []
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            while self._waiting and self._tokens >= 1:
+                self._tokens = self._tokens - 1
+                self._admitted = self._admitted + 1
+                ready.append(self._waiting.popleft())
+            if self._waiting:
+                _timer.schedule(now + self._delay(), partial(self._release, release))
+            else:
+                self._scheduled = 0
+        finally:
+            self._lock.release()
+        for job, stage in ready:
+            release(job, stage)
+
+    def _takeWaiting(self):
+        """
+        Removes and returns all the parked jobs.
+        """
+        self._lock.acquire()
+        try:
+            jobs = map(lambda entry: entry[0], self._waiting)
+            self._waiting.clear()
+            return jobs
+        finally:
+            self._lock.release()
+
+    def getWaiting(self):
+        """
+        Returns the number of jobs parked on this bucket.
+        """
+        return len(self._waiting)
+
+    def getState(self):
+        """
+        Returns a dictionary of the bucket's settings and figures: its
+        'rate' and 'burst', the 'tokens' available now, how many jobs are
+        'waiting' for a token, and how many have been 'admitted' and
+        'throttled' (made to wait) so far.
+        """
+        self._lock.acquire()
+        try:
+            self._refill(time.time())
+            return {'rate': self._rate, 'burst': self._burst,
+                    'tokens': self._tokens, 'waiting': len(self._waiting),
+                    'admitted': self._admitted, 'throttled': self._throttled}
+        finally:
+            self._lock.release()
+
+
+class PoolStats:
+    """
+    Counters and latency histograms for a ThreadPool: how long jobs wait in
+    the queue before starting, how long they run, and how many completed,
+    failed, were rejected because the queue was full, expired before their
+    deadline, or were cancelled. Workers update it as they go; snapshot()
+    copies it without stopping them, along with the state of the pool's
+    rate limiters.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = thread.allocate_lock()
+        self._started = time.time()
+        self._queueWait = Histogram()
+        self._runTime = Histogram()
+        self._busyTime = 0.0
+        self._counts = {'completed': 0, 'failed': 0, 'rejected': 0,
+                        'expired': 0, 'cancelled': 0}
+
+    def count(self, name, n = 1):
+        self._lock.acquire()
+        self._counts[name] = self._counts[name] + n
+        self._lock.release()
+
+    def recordWait(self, seconds):
+        self._lock.acquire()
+        self._queueWait.record(seconds)
+        self._lock.release()
+
+    def recordRun(self, seconds, failed):
+        self._lock.acquire()
+        self._runTime.record(seconds)
+        self._busyTime = self._busyTime + seconds
+        if failed:
+            self._counts['failed'] = self._counts['failed'] + 1
+        else:
+            self._counts['completed'] = self._counts['completed'] + 1
+        self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the current figures. Durations are in
+        seconds. 'jobsPerSecond' is the rate of finished (completed or
+        failed) jobs since the stats were started, and 'utilization' is
+        the fraction of live threads which are busy right now. 'rateLimit'
+        is the state of the pool-wide TokenBucket, or None, and
+        'keyRateLimits' maps each rate limiting key, as a string, to the
+        state of its bucket; see TokenBucket.getState.
+        """
+        self._lock.acquire()
+        try:
+            counts = self._counts.copy()
+            queueWait = self._queueWait.copy()
+            runTime = self._runTime.copy()
+            busyTime = self._busyTime
+        finally:
+            self._lock.release()
+        elapsed = time.time() - self._started
+        live = len(self._pool.getLiveThreads())
+        busy = len(self._pool.getBusyThreads())
+        snap = counts
+        snap['queueWait'] = queueWait.summary()
+        snap['runTime'] = runTime.summary()
+        snap['busyTime'] = busyTime
+        snap['elapsed'] = elapsed
+        snap['jobsPerSecond'] = (counts['completed'] + counts['failed']) / max(elapsed, 1e-9)
+        snap['queued'] = self._pool.qsize()
+        snap['liveThreads'] = live
+        snap['busyThreads'] = busy
+        snap['utilization'] = busy / float(max(live, 1))
+        limiter = self._pool._rateLimiter
+        snap['rateLimit'] = limiter and limiter.getState()
+        snap['keyRateLimits'] = dict(map(lambda item: (str(item[0]), item[1].getState()),
+                                         self._pool._keyLimiters.items()))
+        return snap
+
+
+class ThreadPool(Queue.Queue):
+    """
+    Creates and maintains a pool of threads. Jobs are queued by calling put.
+
+    The shared queue is a priority queue: jobs with a higher priority are
+    started first, and jobs of equal priority are started in the order they
+    were queued. Jobs may also have a deadline, a time.time() value after
+    which they are no longer worth starting. A worker which takes a job whose
+    deadline has passed loads its ReturnValue with a TimeoutError instead of
+    running it.
+
+    The pool grows towards maxThreads while jobs are waiting for a worker,
+    and, if a keepAlive time is given, shrinks back towards minThreads as
+    threads sit idle.
+    """
+    def __init__(self, name = "Thread Pool", minThreads = 2, maxThreads = 10, daemon = 1,
+                 workStealing = 0, maxQueued = 0, blockWhenFull = 1,
+                 keepAlive = None, growAfter = .01, initializer = None,
+                 finalizer = None, errorFunc = None, rateLimit = None,
+                 rateBurst = None):
+        """
+        If *maxQueued* is more than zero, at most that many jobs may wait in
+        the shared queue. When it is full, put blocks until there is room if
+        *blockWhenFull* is true, and otherwise raises Queue.Full.
+
+        Threads beyond *minThreads* exit once they have been idle for
+        *keepAlive* seconds. If *keepAlive* is None, the pool never shrinks.
+
+        The pool grows on queue wait rather than queue length: only when jobs
+        are waiting for a worker and have been waiting, on recent evidence
+        (see getQueueWait), for at least *growAfter* seconds, ten
+        milliseconds by default. While jobs are waiting but not yet for
+        that long, the pool checks again *growAfter* seconds later, so a
+        backlog which persists always gets threads. A *growAfter* of zero
+        grows the pool as soon as there is a job for which no thread is
+        idle.
+
+        If *workStealing* is true, each worker thread also gets a deque of its
+        own. Jobs put on the pool from inside one of its workers go on that
+        worker's deque, where the worker takes the newest first, and idle
+        workers steal the oldest jobs from the others before blocking on the
+        shared queue. A worker which waits on a ReturnValue runs jobs from
+        its own deque, or stolen from the others, until the value is loaded.
+        This suits recursive divide-and-conquer jobs, which queue jobs and
+        wait on their results: in the normal mode, they can tie up every
+        thread waiting on jobs which no thread is left to run.
+
+        *initializer* and *finalizer* are passed to each Worker, to set up
+        and tear down per-thread state; see Worker.getResource. So is
+        *errorFunc*, which is called with the job and sys.exc_info() whenever
+        a job raises an exception.
+
+        If *rateLimit* is given, workers start at most that many jobs per
+        second, with bursts of up to *rateBurst*; see setRateLimit.
+        """
+        Queue.Queue.__init__(self, maxQueued)
         self._pool = []
+        self._sizeLock = threading.Lock()
+        self._blockWhenFull = blockWhenFull
+        self._keepAlive = keepAlive
+        self._growAfter = growAfter
+        self._growCheck = 0
+        self._lastTaken = time.time()
+        self._queueWait = 0.0
+        self._stats = PoolStats(self)
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._errorFunc = errorFunc
+        self._rateLimiter = None
+        self._keyLimiters = {}
+        if rateLimit is not None:
+            self.setRateLimit(rateLimit, rateBurst)
+        self._workStealing = workStealing
+        self._localQueues = {}
+        self._sleepers = 0
+        self._sleepLock = thread.allocate_lock()
+        if workStealing:
+            self._source = self._nextJob
+        else:
+            self._source = self._nextShared
         self._name = name
         self._minThreads = minThreads
         self._maxThreads = maxThreads
         self._threadCounter = 0
         self._dead = 0
+        self._cancelling = 0
         self._daemon = daemon
         self.checkThreads()
 
+    def _init(self, maxsize):
+        self.queue = []
+        self._sequence = 0
+        self._withdrawn = 0
+
+    def _qsize(self, len = len):
+        #Withdrawn jobs stay in the heap until they are popped, but no
+        #longer count against the queue's size.
+        return len(self.queue) - self._withdrawn
+
+    def _put(self, entry):
+        #Called with the queue's mutex held. *entry* is a (priority, job) pair;
+        #the sequence number keeps equal priorities in FIFO order.
+        priority, job = entry
+        heapq.heappush(self.queue, (-priority, self._sequence, job))
+        self._sequence = self._sequence + 1
+        if job[1] is not None:
+            job[1].__dict__['_queuedIn'] = self
+
+    def _get(self):
+        while 1:
+            job = heapq.heappop(self.queue)[2]
+            if job[1] is None or job[1].__dict__.pop('_queuedIn', None) is not None:
+                return job
+            #Withdrawn, and already taken off the count.
+            self._withdrawn = self._withdrawn - 1
+
+    def _withdraw(self, rv):
+        """
+        Takes the job for *rv*, which has been cancelled or has timed out,
+        off the shared queue, so that it no longer counts towards qsize or
+        takes up room in a bounded queue. Its entry is skipped when it
+        reaches the front, and withdrawn entries are dropped from the heap
+        once they make up half of it.
+        """
+        self.mutex.acquire()
+        try:
+            if rv.__dict__.pop('_queuedIn', None) is not self:
+                return
+            self._withdrawn = self._withdrawn + 1
+            if self._withdrawn * 2 > len(self.queue):
+                self.queue = filter(lambda entry: entry[2][1] is None or
+                                    entry[2][1].__dict__.has_key('_queuedIn'),
+                                    self.queue)
+                heapq.heapify(self.queue)
+                self._withdrawn = 0
+            self.not_full.notify()
+        finally:
+            self.mutex.release()
+
     def isDaemon(self):
         return self._daemon
+
+    def getStats(self):
+        """
+        Returns this pool's PoolStats.
+        """
+        return self._stats
     
 
+    def setRateLimit(self, rate, burst = None, key = None):
+        """
+        Limits the rate at which workers start jobs to *rate* per second,
+        with bursts of up to *burst*, using a TokenBucket. If *key* is given,
+        the limit applies only to jobs put with that rateKey, on top of the
+        pool-wide limit, if any. A *rate* of None removes the limit; jobs
+        already waiting on it still wait for their token.
+
+        Limits are applied as workers take jobs from the queue. A job over
+        its limit is set aside until a token is available, and the worker
+        moves on to other jobs, so throttled jobs never hold a thread.
+        """
+        if rate is None:
+            limiter = None
+        else:
+            limiter = TokenBucket(rate, burst)
+        if key is None:
+            self._rateLimiter = limiter
+        elif limiter is None:
+            self._keyLimiters.pop(key, None)
+        else:
+            self._keyLimiters[key] = limiter
+
+    def getRateLimiter(self, key = None):
+        """
+        Returns the TokenBucket limiting jobs with rateKey *key*, or the
+        pool-wide one if *key* is None. Returns None if there is no limit.
+        """
+        if key is None:
+            return self._rateLimiter
+        return self._keyLimiters.get(key)
+
     def getThreads(self):
         """
         Returns a list of all threads in this pool, whether alive, dead, busy, or idle.
@@ -301,28 +1673,106 @@ class ThreadPool(Queue.Queue):
         return filter(lambda x:x.isAlive(), self._pool)
 
     def _addThread(self):
-        w = Worker(self.get, name = self._name + " - " + str(self._threadCounter ))
+        w = Worker(self._getJob, name = self._name + " - " + str(self._threadCounter ),
+                   reportFunc = self._stats.recordRun,
+                   initializer = self._initializer, finalizer = self._finalizer,
+                   errorFunc = self._errorFunc,
+                   helpFunc = self._workStealing and self._helpUntil or None)
+        if self._workStealing:
+            self._localQueues[w] = deque()
         self._threadCounter  = self._threadCounter  + 1
         self._pool.append(w)
         w.setDaemon(self.isDaemon())
         w.start()
 
+    def shutdown(self, wait = 1, cancel_pending = 0, timeout = None):
+        """
+        Stops the pool accepting jobs and tells its threads to exit once the
+        jobs already queued have run. If *cancel_pending* is true, jobs which
+        have not started yet are not run; their ReturnValues raise
+        CancelledError instead. If *wait* is true, blocks until the threads
+        have exited, or for at most *timeout* seconds if that is given.
+        Returns 1 if all the threads have exited, 0 otherwise.
+
+        shutdown may be called again, for instance to cancel what is left
+        after an earlier shutdown without cancellation.
+        """
+        self._sizeLock.acquire()
+        try:
+            first = not self._dead
+            self._dead = 1
+            workers = self.getLiveThreads()
+        finally:
+            self._sizeLock.release()
+        if cancel_pending:
+            self._cancelling = 1
+            self._cancelPending()
+        if first:
+            for worker in workers:
+                #Bypass the call to checkThreads in our own put method...
+                #...and queue after everything else, so pending jobs still run.
+                self._putInternal((-sys.maxint, _stop))
+        if wait:
+            if timeout is not None:
+                endtime = time.time() + timeout
+            for worker in workers:
+                if timeout is None:
+                    worker.join()
+                else:
+                    worker.join(max(endtime - time.time(), 0))
+        return not filter(lambda x:x.isAlive(), workers)
+
     def shutDown(self):
         """
         Cause this pool to shut down gracefully, by refusing to create new threads,
         and scheduling None (treated as a command to end) jobs for all its live
-        threads.
+        threads. Does not wait for the threads to exit; see shutdown.
         """
-        self._dead = 1
-        for thread in self._pool :
-            #Bypass the call to checkThreads in our own put method...
-            Queue.Queue.put(self, (None, None, None))
+        self.shutdown(wait = 0)
 
-    def restart(self):
-        if not self._dead:
-            self.shutDown()
-        while self.getLiveThreads():
-            sleep(100)
+    def restart(self, cancel_pending = 0, timeout = None):
+        """
+        Shuts the pool down, waiting for its threads to exit as shutdown
+        does, and then starts a fresh set of threads.
+        """
+        self.shutdown(1, cancel_pending, timeout)
+        self._dead = 0
+        self._cancelling = 0
+        self.checkThreads()
+
+    def _cancelPending(self):
+        """
+        Removes every job which has not started from the queue and the
+        workers' deques, loading their ReturnValues with CancelledError.
+        """
+        self.mutex.acquire()
+        try:
+            entries = self.queue
+            self._init(self.maxsize)
+            cancelled = []
+            for entry in entries:
+                if entry[2][0]:
+                    entry[2][1].__dict__.pop('_queuedIn', None)
+                    cancelled.append(entry[2])
+                else:
+                    heapq.heappush(self.queue, entry)
+            self.unfinished_tasks = self.unfinished_tasks - len(cancelled)
+            self.not_full.notifyAll()
+        finally:
+            self.mutex.release()
+        for local in self._localQueues.values():
+            while 1:
+                try:
+                    cancelled.append(local.popleft())
+                except IndexError:
+                    break
+        for limiter in [self._rateLimiter] + self._keyLimiters.values():
+            if limiter is not None:
+                cancelled.extend(limiter._takeWaiting())
+        for job in cancelled:
+            if job[1]._claim():
+                job[1].load(CancelledError("The pool was shut down before the job ran."),
+                            asException = 1)
 
     def checkThreads(self):
         """
@@ -331,22 +1781,996 @@ class ThreadPool(Queue.Queue):
         """
         if self._dead:
             raise RuntimeError, "This pool has been shut down."
-        self._pool = self.getLiveThreads()
-        while len(self._pool ) < self._minThreads:
-            self._addThread()
-        while len(self.getIdleThreads()) < self.qsize():
-            if len(self._pool) < self._maxThreads:
+        self._sizeLock.acquire()
+        try:
+            self._pool = self.getLiveThreads()
+            pending = self.qsize()
+            if self._workStealing:
+                pending = pending + self._reapLocalQueues()
+            while len(self._pool ) < self._minThreads:
+                self._addThread()
+            #New threads start out idle, so count the shortfall once rather than
+            #rescanning the pool for every thread added.
+            shortfall = pending - len(self.getIdleThreads())
+            if shortfall > 0 and self._pool and self.getQueueWait() < self._growAfter:
+                shortfall = 0
+                if not self._growCheck:
+                    self._growCheck = 1
+                    _timer.schedule(time.time() + self._growAfter, self._recheckThreads)
+            while shortfall > 0 and len(self._pool) < self._maxThreads:
                 self._addThread()
+                shortfall = shortfall - 1
+        finally:
+            self._sizeLock.release()
+
+    def _recheckThreads(self):
+        #Called on the timer thread when growth was put off.
+        self._growCheck = 0
+        if not self._dead:
+            try:
+                self.checkThreads()
+            except RuntimeError:
+                #Shut down in the meantime.
+                pass
+
+    def getQueueWait(self):
+        """
+        Returns an estimate, in seconds, of how long jobs are currently
+        waiting in the queue before a worker starts them: a moving average of
+        recent waits, or the time since a worker last took a job, whichever
+        is longer.
+        """
+        sinceTaken = time.time() - self._lastTaken
+        if not self.qsize() or sinceTaken < self._queueWait:
+            return self._queueWait
+        return sinceTaken
+
+    def _retire(self):
+        """
+        Removes the calling worker from the pool if the pool has more than
+        minThreads live threads, returning 1 if it did, 0 otherwise.
+        """
+        me = threading.currentThread()
+        self._sizeLock.acquire()
+        try:
+            self._pool = self.getLiveThreads()
+            if len(self._pool) <= self._minThreads or me not in self._pool:
+                return 0
+            self._pool.remove(me)
+            local = self._localQueues.get(me)
+            if local is not None:
+                del self._localQueues[me]
+                for job in local:
+                    self._putInternal((0, job))
+            return 1
+        finally:
+            self._sizeLock.release()
+
+    def _putInternal(self, entry):
+        """
+        Queues a (priority, job) *entry* even if the queue is full. Used for
+        the pool's own bookkeeping jobs.
+        """
+        self.not_empty.acquire()
+        try:
+            self._put(entry)
+            self.unfinished_tasks = self.unfinished_tasks + 1
+            self.not_empty.notify()
+        finally:
+            self.not_empty.release()
+
+    def put(self, item, block = 1, associated = None, priority = 0, deadline = None,
+            timeout = None, rateKey = None):
+        """
+        Queues the no-args function *item*, and returns its ReturnValue.
+        Jobs with a higher *priority* are started before those with a lower
+        one. If *deadline* (a time.time() value) passes before the job is
+        started, it is not run, and its ReturnValue raises TimeoutError.
+        If the job hasn't finished *timeout* seconds from now, its
+        ReturnValue raises TimeoutError, and if it is running its
+        CancelToken is set.
+        If the queue is full, *block* and the pool's blockWhenFull setting
+        must both be true for put to wait for room; otherwise it raises
+        Queue.Full.
+        If *rateKey* is given, the job is subject to the rate limit set for
+        that key with setRateLimit, as well as to the pool-wide one.
+        """
+        rv = ReturnValue(self)
+        if timeout is not None:
+            if deadline is None or time.time() + timeout < deadline:
+                deadline = time.time() + timeout
+            self._queueJob(item, rv, block, associated, priority, deadline, rateKey)
+            rv._expireAt(time.time() + timeout, timeout)
+        else:
+            self._queueJob(item, rv, block, associated, priority, deadline, rateKey)
+        return rv
+
+    def _queueContinuation(self, item, rv):
+        """
+        Queues *item* with ReturnValue *rv* after the pool has been shut
+        down, ahead of the threads' stop jobs, so that continuations of jobs
+        accepted before shutdown still run while the pool drains. Returns 0,
+        and queues nothing, if pending jobs were cancelled or no threads are
+        left to run it.
+        """
+        if self._cancelling or not self.getLiveThreads():
+            return 0
+        self._putInternal((0, (item, rv, None, None, time.time(), 0, None)))
+        return 1
+
+    def _queueJob(self, item, rv, block = 1, associated = None, priority = 0,
+                  deadline = None, rateKey = None):
+        """
+        Queues *item* as put does, but with a ReturnValue supplied by the
+        caller.
+        """
+        if self._dead:
+            raise RuntimeError, "This pool has been shut down."
+        job = (item, rv, associated, deadline, time.time(), priority, rateKey)
+        if not (self._workStealing and self._putLocal([job])):
+            try:
+                Queue.Queue.put(self, (priority, job), 0)
+            except Queue.Full:
+                if not (block and self._blockWhenFull):
+                    self._stats.count('rejected')
+                    raise
+                #Make sure there are threads to drain the queue before
+                #waiting on it.
+                self.checkThreads()
+                Queue.Queue.put(self, (priority, job), 1)
+        #Checked once the job is queued, so that it counts towards the
+        #backlog the pool is sized for.
+        self.checkThreads()
+
+    def put_many(self, items, associated = None, priority = 0, deadline = None,
+                 timeout = None, rateKey = None):
+        """
+        Queues every no-args function in *items* as a separate job, and
+        returns a list of their ReturnValues. The queue is locked once for
+        the whole batch, and the pool size is checked once afterwards,
+        rather than once per job as with put. *priority*, *deadline* and
+        *timeout* and *rateKey* apply to every job, as for put.
+
+        If the queue is bounded and the pool's blockWhenFull setting is true,
+        the jobs are queued one at a time, each waiting for room as put
+        does. Otherwise the whole batch is refused with Queue.Full, and none
+        of it is queued, unless there is room for all of it.
+        """
+        if self._dead:
+            raise RuntimeError, "This pool has been shut down."
+        now = time.time()
+        if timeout is not None and (deadline is None or now + timeout < deadline):
+            deadline = now + timeout
+        jobs = map(lambda item, a = associated, d = deadline, now = now, p = priority,
+                          k = rateKey:
+                   (item, ReturnValue(self), a, d, now, p, k), items)
+        if jobs and self._workStealing and self._putLocal(jobs):
+            self.checkThreads()
+        elif jobs and self.maxsize > 0 and self._blockWhenFull:
+            for job in jobs:
+                try:
+                    Queue.Queue.put(self, (priority, job), 0)
+                except Queue.Full:
+                    #Make sure there are threads to drain the queue before
+                    #waiting on it.
+                    self.checkThreads()
+                    Queue.Queue.put(self, (priority, job), 1)
+            self.checkThreads()
+        elif jobs:
+            #Nothing here waits on not_full: an unbounded queue never fills,
+            #and a batch for a bounded one goes in whole or not at all, so
+            #that the caller gets the ReturnValue of every job queued.
+            self.not_empty.acquire()
+            try:
+                if self.maxsize > 0 and self.maxsize - self._qsize() < len(jobs):
+                    self._stats.count('rejected', len(jobs))
+                    raise Queue.Full
+                for job in jobs:
+                    self._put((priority, job))
+                self.unfinished_tasks = self.unfinished_tasks + len(jobs)
+                self.not_empty.notify(len(jobs))
+            finally:
+                self.not_empty.release()
+            self.checkThreads()
+        rvs = map(lambda job: job[1], jobs)
+        if timeout is not None:
+            for rv in rvs:
+                rv._expireAt(now + timeout, timeout)
+        return rvs
+
+    def _getJob(self):
+        """
+        The job source for workers. Jobs over a rate limit are set aside
+        until they are admitted. Jobs whose deadline has passed are
+        failed with TimeoutError and skipped. Surplus workers which wait
+        longer than keepAlive for a job are told to stop.
+        """
+        while 1:
+            if self._keepAlive is None or len(self._pool) <= self._minThreads:
+                job = self._source()
+            else:
+                try:
+                    job = self._source(self._keepAlive)
+                except Queue.Empty:
+                    if self._retire():
+                        return _stop
+                    continue
+            if not job[0]:
+                if job is _stop and self._holdStop():
+                    continue
+                return job
+            job = self._accept(job)
+            if job is not None:
+                return job
+
+    def _accept(self, job):
+        """
+        Returns *job* if a worker which has taken it from a queue should run
+        it, or None if it was set aside by a rate limiter, was cancelled or
+        timed out while queued, or has missed its deadline.
+        """
+        if job[6] is not _admitted and (job[6] is not None or self._rateLimiter):
+            if self._admit(job, 0) is None:
+                return None
+        if not job[1]._claim():
+            #Cancelled, or timed out, while it was queued.
+            return None
+        now = time.time()
+        self._lastTaken = now
+        self._queueWait = self._queueWait * .8 + (now - job[4]) * .2
+        self._stats.recordWait(now - job[4])
+        deadline = job[3]
+        if deadline is None or now <= deadline:
+            return job
+        self._stats.count('expired')
+        job[1].load(TimeoutError("Deadline passed before the job started."),
+                    asException = 1)
+        return None
+
+    def _helpUntil(self, completion, timeout = None):
+        """
+        The help function for workers in work-stealing mode. Runs jobs from
+        the worker's own deque, newest first, or stolen from the others,
+        until *completion* is set, waiting on it a little at a time when
+        there is nothing to run. Returns 1 if it was set, 0 if *timeout*
+        seconds passed first.
+        """
+        me = threading.currentThread()
+        local = self._localQueues.get(me)
+        if timeout is not None:
+            endtime = time.time() + timeout
+        delay = .0005
+        while not completion.isSet():
+            job = None
+            if local:
+                try:
+                    job = local.pop()
+                except IndexError:
+                    pass
+            if job is None:
+                job = self._steal(me)
+            if job is not None:
+                job = self._accept(job)
+                if job is not None:
+                    me._runJob(job)
+                delay = .0005
+                continue
+            if timeout is None:
+                wait = delay
+            else:
+                wait = min(delay, endtime - time.time())
+                if wait <= 0:
+                    return 0
+            if completion.wait(wait):
+                return 1
+            delay = min(delay * 2, .02)
+        return 1
+
+    def _admit(self, job, stage):
+        """
+        Passes *job* through its rate limiters, starting at *stage*: 0 for
+        its key's limiter and 1 for the pool-wide one. Returns the job if it
+        may start now; otherwise it is parked on the limiter which refused
+        it, and None is returned.
+        """
+        if job[6] is None:
+            limiters = (None, self._rateLimiter)
+        else:
+            limiters = (self._keyLimiters.get(job[6]), self._rateLimiter)
+        for i in xrange(stage, len(limiters)):
+            limiter = limiters[i]
+            if limiter is not None and not limiter._admit(job, i, self._release):
+                return None
+        return job
+
+    def _release(self, job, stage):
+        """
+        Called by a limiter when a parked *job* gets its token. If the job's
+        other limiters admit it too, it goes back on the queue, at its
+        original priority, to be run without further checks.
+        """
+        if self._admit(job, stage + 1) is not None:
+            self._putInternal((job[5], job[:6] + (_admitted,)))
+
+    def _holdStop(self):
+        """
+        If jobs are parked on a rate limiter, requeues a stop command for
+        when the next of them is due, so that the pool does not shut down
+        under them, and returns 1. Otherwise returns 0.
+        """
+        delays = []
+        for limiter in [self._rateLimiter] + self._keyLimiters.values():
+            if limiter is not None and limiter.getWaiting():
+                delays.append(1 / limiter._rate)
+        if not delays:
+            return 0
+        _timer.schedule(time.time() + min(delays),
+                        partial(self._putInternal, (-sys.maxint, _stop)))
+        return 1
+
+    def _putLocal(self, jobs):
+        """
+        If the current thread is one of this pool's workers, appends *jobs*
+        to its local deque, wakes any sleeping workers so they can steal them,
+        and returns 1. Otherwise returns 0.
+        """
+        local = self._localQueues.get(threading.currentThread())
+        if local is None:
+            return 0
+        local.extend(jobs)
+        #A worker going to sleep registers itself before its last scan of the
+        #deques, so either it sees these jobs, or we see it here.
+        for i in xrange(min(self._sleepers, len(jobs))):
+            self._putInternal((sys.maxint, _wakeup))
+        return 1
+
+    def _steal(self, thief):
+        """
+        Takes the oldest job from another worker's deque, or returns None.
+        """
+        victims = self._localQueues.items()
+        if not victims:
+            return None
+        start = random.randrange(len(victims))
+        for victim, local in victims[start:] + victims[:start]:
+            if victim is not thief:
+                try:
+                    return local.popleft()
+                except IndexError:
+                    pass
+        return None
+
+    def _nextShared(self, timeout = None):
+        """
+        The job source for workers in the normal mode: the shared queue.
+        """
+        return self.get(1, timeout)
+
+    def _nextJob(self, timeout = None):
+        """
+        The job source for workers in work-stealing mode: the worker's own
+        deque first, then the shared queue, then the other workers' deques,
+        and finally a wait of up to *timeout* seconds on the shared queue.
+        """
+        me = threading.currentThread()
+        local = self._localQueues[me]
+        while 1:
+            try:
+                return local.pop()
+            except IndexError:
+                pass
+            try:
+                job = self.get_nowait()
+            except Queue.Empty:
+                job = self._steal(me)
+            if job is None:
+                self._sleepLock.acquire()
+                self._sleepers = self._sleepers + 1
+                self._sleepLock.release()
+                try:
+                    job = self._steal(me)
+                    if job is None:
+                        job = self.get(1, timeout)
+                finally:
+                    self._sleepLock.acquire()
+                    self._sleepers = self._sleepers - 1
+                    self._sleepLock.release()
+            if job is not _wakeup:
+                return job
+
+    def _reapLocalQueues(self):
+        """
+        Drops the deques of dead workers, moving any jobs left on them to the
+        shared queue. Returns the number of jobs waiting on live workers'
+        deques.
+        """
+        pending = 0
+        for worker, local in self._localQueues.items():
+            if worker.isAlive():
+                pending = pending + len(local)
             else:
-                break
+                del self._localQueues[worker]
+                for job in local:
+                    self._putInternal((0, job))
+        return pending
+
+    def map(self, func, iterable, chunksize = 1):
+        """
+        Like the builtin map, but calls *func* on each item of *iterable* in
+        the pool's threads, *chunksize* items per job. Blocks until all the
+        results are available, and returns them as a list in order. If any
+        call raised an exception, it is raised here.
+        """
+        results = []
+        for rv in self.put_many(_chunkJobs(func, iterable, chunksize)):
+            results.extend(rv.eval())
+        return results
+
+    def imap_unordered(self, func, iterable, chunksize = 1):
+        """
+        Like map, but returns an iterator which yields results as soon as
+        their jobs finish, in whatever order that happens to be.
+        """
+        finished = Queue.Queue(0)
+        rvs = self.put_many(_chunkJobs(func, iterable, chunksize))
+        #Callbacks, rather than the jobs themselves, report each outcome, so
+        #that cancelled and timed out chunks are reported too.
+        for rv in rvs:
+            rv.addCallback(finished.put)
+        return _drain(finished, len(rvs))
+
+
+class ProcessPool:
+    """
+    A pool of worker processes with the same put contract as ThreadPool, for
+    work which is limited by the global interpreter lock. Jobs and their
+    results are pickled to and from the worker processes, so jobs must be
+    picklable: module-level functions, or instances of module-level classes,
+    rather than lambdas or closures.
+
+    If *maxTasks* is given, each worker process is replaced by a fresh one
+    after it has run that many jobs (chunks, for put_many, map and
+    imap_unordered).
+
+    Jobs are pickled by put and put_many, so a job which can't be pickled
+    fails straight away; its ReturnValue raises the pickling error. So does
+    the ReturnValue of a job whose result can't be pickled.
+    """
+    def __init__(self, name = "Process Pool", processes = None, maxTasks = None):
+        if multiprocessing is None:
+            raise RuntimeError, "ProcessPool requires the multiprocessing module."
+        self._name = name
+        self._processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self._processes,
+                                          maxtasksperchild = maxTasks)
+        self._dead = 0
+        #multiprocessing only calls back on success, so a thread watches the
+        #jobs' AsyncResults to pass on any failure.
+        self._results = Queue.Queue()
+        self._collector = threading.Thread(target = self._collect,
+                                           name = name + " - Collector")
+        self._collector.setDaemon(1)
+        self._collector.start()
+
+    def getProcessCount(self):
+        return self._processes
+
+    def _checkAlive(self):
+        if self._dead:
+            raise RuntimeError, "This pool has been shut down."
+
+    def _submit(self, func, args, rvs, callback):
+        """
+        Sends func(*args) to the worker processes, with *callback* to load
+        *rvs* when it succeeds. If it can't be sent, or fails in the pool,
+        the error is loaded into *rvs* instead.
+        """
+        try:
+            result = self._pool.apply_async(func, args, callback = callback)
+        except:
+            _loadError(rvs, sys.exc_info())
+        else:
+            self._results.put((result, rvs))
+
+    def _collect(self):
+        """
+        Loads the errors of failed jobs. Rather than waiting on each job in
+        turn, which would hold up a failure behind slower jobs queued before
+        it, it checks all the unfinished jobs every so often.
+        """
+        pending = []
+        stopping = 0
+        delay = .001
+        nextCheck = time.time() + delay
+        while pending or not stopping:
+            try:
+                if pending:
+                    entry = self._results.get(1, max(nextCheck - time.time(), 0))
+                else:
+                    entry = self._results.get()
+                    delay = .001
+                    nextCheck = time.time() + delay
+                if entry is None:
+                    stopping = 1
+                else:
+                    pending.append(entry)
+            except Queue.Empty:
+                pass
+            if time.time() < nextCheck:
+                continue
+            unfinished = []
+            for result, rvs in pending:
+                if not result.ready():
+                    unfinished.append((result, rvs))
+                elif not result.successful():
+                    try:
+                        result.get()
+                    except:
+                        _loadError(rvs, sys.exc_info())
+            if len(unfinished) < len(pending):
+                delay = .001
+            else:
+                delay = min(delay * 2, .05)
+            pending = unfinished
+            nextCheck = time.time() + delay
 
     def put(self, item, block = 1, associated = None):
-        self.checkThreads()
+        """
+        Queues the no-args function *item* to run in a worker process, and
+        returns its ReturnValue. *block* and *associated* are accepted for
+        compatibility with ThreadPool.put; the process queue is unbounded, and
+        there is no Worker thread to associate a value with, so both are
+        ignored.
+        """
+        self._checkAlive()
         rv = ReturnValue()
-        Queue.Queue.put(self, (item, rv, associated), block)
+        try:
+            data = cPickle.dumps(item, 2)
+        except:
+            _loadError([rv], sys.exc_info())
+        else:
+            self._submit(_runPickled, (data,), [rv],
+                         lambda result, rv = rv: rv.load(*result))
         return rv
 
+    def put_many(self, items, associated = None, chunksize = 1):
+        """
+        Queues every no-args function in *items*, sending them to the worker
+        processes *chunksize* at a time, and returns a list of their
+        ReturnValues.
+        """
+        self._checkAlive()
+        if chunksize < 1:
+            raise ValueError, "chunksize must be at least 1"
+        rvs = []
+        sent = []
+        datas = []
+        for item in items:
+            rv = ReturnValue()
+            rvs.append(rv)
+            try:
+                datas.append(cPickle.dumps(item, 2))
+            except:
+                _loadError([rv], sys.exc_info())
+            else:
+                sent.append(rv)
+        for start in xrange(0, len(datas), chunksize):
+            chunk = sent[start:start + chunksize]
+            def loadChunk(results, rvs = chunk):
+                for rv, result in zip(rvs, results):
+                    rv.load(*result)
+            self._submit(_runPickledChunk, (datas[start:start + chunksize],),
+                         chunk, loadChunk)
+        return rvs
+
+    def map(self, func, iterable, chunksize = 1):
+        """
+        Like ThreadPool.map, but runs in the worker processes.
+        """
+        self._checkAlive()
+        return self._pool.map(func, iterable, chunksize)
+
+    def imap_unordered(self, func, iterable, chunksize = 1):
+        """
+        Like ThreadPool.imap_unordered, but runs in the worker processes.
+        """
+        self._checkAlive()
+        return self._pool.imap_unordered(func, iterable, chunksize)
+
+    def shutDown(self):
+        """
+        Refuses further jobs, and lets the worker processes exit once the
+        jobs already queued have finished.
+        """
+        if not self._dead:
+            self._dead = 1
+            self._pool.close()
+            self._results.put(None)
+
+    def join(self):
+        """
+        Waits for the worker processes to exit. Call shutDown first.
+        """
+        self._pool.join()
+
+
+def _runPickled(data):
+    """
+    Unpickles and runs a job in a worker process, returning a (value,
+    asException) pair suitable for ReturnValue.load. Any exception is returned, as in a
+    ThreadPool worker; one such as SystemExit would otherwise end the
+    worker process and lose the job.
+    """
+    try:
+        return cPickle.loads(data)(), 0
+    except:
+        return sys.exc_info()[1], 1
+
+def _runPickledChunk(datas):
+    return map(_runPickled, datas)
+
+def _loadError(rvs, excInfo):
+    for rv in rvs:
+        rv.load(excInfo[1], asException = 1, tb = excInfo[2])
+
+
+#Queued to wake a sleeping worker in work-stealing mode, so that it goes
+#back to look for jobs to steal. Workers never run it.
+_wakeup = (None, None, None, None, "wakeup", None, None)
+
+#Returned to a worker to make it exit.
+_stop = (None, None, None, None, None, None, None)
+
+#Put in place of the rate limiting key of a job which has been through its
+#rate limiters and has its tokens.
+_admitted = ("admitted",)
+
+
+class AsyncioPool:
+    """
+    Adapts a ThreadPool (or ProcessPool) for use from asyncio coroutines.
+    Jobs run on the pool's threads as usual, and their results are delivered
+    to the event loop as Futures, so any number of coroutines can wait on
+    blocking calls without freezing the loop or parking a thread per wait.
+    Under Python 2 the event loop comes from trollius:
+
+    >>> pool = AsyncioPool(ThreadPool())
+    >>> @trollius.coroutine
+    ... def handler(key):
+    ...     row = yield From(pool.submit(db.fetch, key))
+    ...     pages = pool.stream(render, row.pages)
+    ...     while 1:
+    ...         page = pages.getNext()
+    ...         if page is None:
+    ...             break
+    ...         send((yield From(page)))
+    """
+    def __init__(self, pool, loop = None):
+        if asyncio is None:
+            raise RuntimeError, "AsyncioPool requires the asyncio module."
+        self._pool = pool
+        self._loop = loop
+
+    def getPool(self):
+        return self._pool
+
+    def _getLoop(self):
+        if self._loop is None:
+            return asyncio.get_event_loop()
+        return self._loop
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) on the pool, and returns a Future
+        for its result.
+        """
+        return self._pool.put(partial(func, *args, **kwargs)).asFuture(self._getLoop())
+
+    def as_completed(self, func, iterable):
+        """
+        Queues func(item) for each item of *iterable*, and returns an iterator
+        of awaitables which yield the results in the order they finish, as
+        asyncio.as_completed does.
+        """
+        loop = self._getLoop()
+        rvs = self._pool.put_many(map(lambda item, func = func: partial(func, item),
+                                      iterable))
+        return asyncio.as_completed(map(lambda rv, loop = loop: rv.asFuture(loop), rvs))
+
+    def stream(self, func, iterable):
+        """
+        Queues func(item) for each item of *iterable*, and returns a stream
+        of the results in the order they finish. Each call to the stream's
+        getNext method returns a Future for the next result, or None once
+        every result has been handed out.
+        """
+        rvs = self._pool.put_many(map(lambda item, func = func: partial(func, item),
+                                      iterable))
+        return _ResultStream(rvs, self._getLoop())
+
 
+class TaskGraph:
+    """
+    Runs a graph of dependent jobs on a ThreadPool. Each task is queued as
+    soon as all the tasks it depends on have finished, and is called with
+    their results as arguments, in the order the dependencies were listed.
+    Independent tasks run in parallel, and no thread is ever blocked waiting
+    for a dependency, so a graph can't starve the pool it runs on. If a
+    dependency fails, the tasks depending on it aren't run, and fail with
+    the same exception.
+
+    >>> graph = TaskGraph(pool)
+    >>> graph.add('rows', loadRows)
+    >>> graph.add('clean', cleanRows, ['rows'])
+    >>> graph.add('stats', computeStats, ['clean'])
+    >>> graph.add('report', render, ['clean', 'stats'])
+    >>> graph.wait()
+    >>> graph.getResult('report')
+
+    Tasks can only depend on tasks which have already been added, so a
+    graph can never contain a cycle.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self._tasks = {}
+        self._order = []
+
+    def add(self, name, func, deps = ()):
+        """
+        Adds a task called *name*, which calls *func* with the results of the
+        tasks named in *deps*, and returns its ReturnValue. A task with no
+        dependencies is queued at once.
+        """
+        if self._tasks.has_key(name):
+            raise ValueError, "There is already a task called %s." % repr(name)
+        for dep in deps:
+            if not self._tasks.has_key(dep):
+                raise ValueError, "Unknown dependency %s." % repr(dep)
+        task = _GraphTask(name, func, list(deps))
+        if deps:
+            task.rv = gather(*map(lambda dep: self._tasks[dep].rv, deps)).then(task)
+        else:
+            task.rv = self._pool.put(task)
+        self._tasks[name] = task
+        self._order.append(name)
+        return task.rv
 
+    def getReturnValue(self, name):
+        return self._tasks[name].rv
 
+    def getResult(self, name, timeout = None):
+        """
+        Returns the result of the task called *name*, waiting for it if
+        necessary, as ReturnValue.eval does.
+        """
+        return self._tasks[name].rv.eval(timeout)
 
+    def wait(self, timeout = None):
+        """
+        Blocks until every task has finished, or for at most *timeout*
+        seconds. Returns 1 if they have all finished, 0 otherwise.
+        """
+        rvs = map(lambda name: self._tasks[name].rv, self._order)
+        return len(wait_many(rvs, timeout)) == len(rvs)
+
+    def getCriticalPath(self):
+        """
+        Returns a tuple of the total run time, in seconds, and the list of
+        task names, of the chain of dependent tasks which took longest to
+        run. That chain bounds how fast the graph can finish, however many
+        threads the pool has. Tasks which haven't finished count as taking
+        no time.
+        """
+        longest = {}
+        best = (0.0, [])
+        #Tasks are added after their dependencies, so this is a
+        #topological order.
+        for name in self._order:
+            task = self._tasks[name]
+            before = (0.0, [])
+            for dep in task.deps:
+                if longest[dep][0] > before[0]:
+                    before = longest[dep]
+            longest[name] = (before[0] + task.getRunTime(), before[1] + [name])
+            if longest[name][0] > best[0] or not best[1]:
+                best = longest[name]
+        return best
+
+
+class _GraphTask:
+    """
+    A TaskGraph task. Calling it calls the task's function with the results
+    of its dependencies, and records how long that took.
+    """
+    def __init__(self, name, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.rv = None
+        self.started = None
+        self.finished = None
+
+    def getRunTime(self):
+        if self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def __call__(self, args = ()):
+        self.started = time.time()
+        try:
+            return self.func(*args)
+        finally:
+            self.finished = time.time()
+
+
+class _ResultStream:
+    """
+    The stream returned by AsyncioPool.stream. Loaded values are handed to
+    the event loop as they arrive, and each getNext returns a Future for the
+    next one.
+    """
+    def __init__(self, rvs, loop):
+        self._loop = loop
+        self._remaining = len(rvs)
+        self._ready = deque()
+        self._waiter = None
+        for rv in rvs:
+            rv.addCallback(self._loaded)
+
+    def _loaded(self, rv):
+        self._loop.call_soon_threadsafe(self._deliver, rv)
+
+    def _deliver(self, rv):
+        waiter = self._waiter
+        self._waiter = None
+        if waiter is not None:
+            if not waiter.cancelled():
+                _settleFuture(waiter, rv)
+                return
+            self._remaining = self._remaining + 1
+        self._ready.append(rv)
+
+    def getRemaining(self):
+        """
+        Returns the number of results getNext has yet to hand out.
+        """
+        return self._remaining
+
+    def getNext(self):
+        """
+        Returns a Future for the next result to finish, or None if there are
+        no more. Call it from the event loop's thread, and only once the
+        previous Future is done or cancelled; a cancelled Future's result
+        goes to the next one.
+        """
+        waiter = self._waiter
+        if waiter is not None and waiter.cancelled():
+            #Give back the slot of a waiter cancelled before its result came.
+            self._waiter = None
+            self._remaining = self._remaining + 1
+        if not self._remaining:
+            return None
+        future = _newFuture(self._loop)
+        self._remaining = self._remaining - 1
+        if self._ready:
+            _settleFuture(future, self._ready.popleft())
+        else:
+            self._waiter = future
+        return future
+
+
+class _Timer:
+    """
+    Calls functions at given times, from a single daemon thread which is
+    started when first needed. Used for put timeouts.
+    """
+    def __init__(self, name = "Thread Pool Timer"):
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._sequence = 0
+        self._cancelled = 0
+        self._thread = None
+        self._name = name
+
+    def schedule(self, when, func):
+        """
+        Arranges for *func* to be called at *when*, a time.time() value.
+        Returns an entry which can be passed to cancel.
+        """
+        self._cond.acquire()
+        try:
+            entry = [when, self._sequence, func]
+            heapq.heappush(self._heap, entry)
+            self._sequence = self._sequence + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = self._name)
+                self._thread.setDaemon(1)
+                self._thread.start()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return entry
+
+    def cancel(self, entry):
+        """
+        Stops a scheduled call from happening, and lets go of its function.
+        Cancelled entries are dropped from the heap once they make up half
+        of it, so that calls scheduled far ahead don't pile up.
+        """
+        self._cond.acquire()
+        try:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self._cancelled = self._cancelled + 1
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = filter(lambda entry: entry[2] is not None, self._heap)
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        self._cond.acquire()
+        while 1:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+            entry = heapq.heappop(self._heap)
+            func = entry[2]
+            if func is None:
+                self._cancelled = self._cancelled - 1
+                continue
+            entry[2] = None
+            self._cond.release()
+            try:
+                func()
+            except:
+                traceback.print_exc()
+            func = None
+            self._cond.acquire()
+
+_timer = _Timer()
+
+
+class _ChunkJob:
+    """
+    A no-args job which maps a function over a chunk of items.
+    """
+    def __init__(self, func, chunk):
+        self._func = func
+        self._chunk = chunk
+
+    def __call__(self):
+        return map(self._func, self._chunk)
+
+def _chunkJobs(func, iterable, chunksize):
+    """
+    Splits *iterable* into a list of _ChunkJobs of at most *chunksize* items.
+    """
+    if chunksize < 1:
+        raise ValueError, "chunksize must be at least 1"
+    jobs = []
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            jobs.append(_ChunkJob(func, chunk))
+            chunk = []
+    if chunk:
+        jobs.append(_ChunkJob(func, chunk))
+    return jobs
+
+def _drain(finished, count):
+    """
+    Yields the items of *count* chunk results from *finished*, a queue of
+    loaded ReturnValues, as they arrive. A chunk which failed, was cancelled
+    or timed out raises its exception.
+    """
+    for i in xrange(count):
+        for item in finished.get().eval():
+            yield item